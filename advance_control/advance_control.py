@@ -4,12 +4,21 @@
 from __future__ import print_function
 
 # standard library imports
+from collections import deque
+import heapq
+import itertools
 import json
+import socket
 from logging import lastResort
 import subprocess
 import time
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
 import datetime
-from threading import Thread, Lock
+from threading import Thread, Lock, Condition
+from concurrent.futures import ThreadPoolExecutor
 
 # request HTTP
 import requests
@@ -31,7 +40,10 @@ urls.extend(
         u"/advu", u"plugins.advance_control.update",
         u"/advdisp", u"plugins.advance_control.valve_status_display",
         u"/advsts", u"plugins.advance_control.check_valve_status",
+        u"/advsts-all", u"plugins.advance_control.check_valve_status_all",
         u"/advls", u"plugins.advance_control.valve_latch_send_signal",
+        u"/advjob", u"plugins.advance_control.latch_job_status",
+        u"/advpush", u"plugins.advance_control.valve_push_state",
     ]
 )
 # fmt: on
@@ -45,20 +57,56 @@ priorAdv = [0] * len(gv.srvals)
 devicesAccessProtection = {}
 
 threadCheckOnLine = None
+threadLatchPulses = None
 lastTimeValvesOnLine = {}
 
 runValveOnLine = False
 
+# network devices status check
+pollInterval = 30  # seconds between status checks of each device
+pollWorkers = 8  # devices checked at the same time
+httpTimeout = (3, 5)  # connect and read timeout in seconds for each request
+pushPollInterval = 300  # seconds between status checks in push mode, devices send their changes
+offlinePollMax = 600  # longest seconds between status checks of an off-line device
+relayStates = {}  # valve id -> last known relay state
+
+# URLs of network devices, built when the settings are loaded
+deviceEndpoints = {}  # valve id -> {"status", "on", "off", "channel", "host"}
+deviceSessions = {}  # device host -> requests session, keeps the connection open
+deviceSessionLocks = {}  # device host -> lock, a session is not thread safe and channels share the host
+
+# status of the network devices for the dashboard
+deviceErrors = {}  # valve id -> number of failed requests
+statusVersion = 0  # changes when a relay state, pending command or error count changes
+statusCondition = Condition()
+statusWaitTimeout = 25  # seconds a status request waits for a change
+
+# latch pulses, sent by one worker thread
+latchQueue = []  # heap of (due time, job id, valve id, remaining steps)
+latchCondition = Condition()
+latchJobIds = itertools.count(1)
+latchJobs = {}  # job id -> {"valveId", "status"}
+latchDeviceJob = {}  # valve id -> job id of the pulse in progress
+latchJobsKeep = 50  # finished jobs kept for status queries
+
+# commands to network devices, one worker for each device
+desiredStates = {}  # valve id -> state the relay must be in
+valveWorkers = {}  # valve id -> valve_worker
+valveWorkersLock = Lock()
+
 ################################################################################
 # Auxiliar Functions                                                           #
 ################################################################################
 
-def httpResquestJSON(commandURL):
+def httpResquestJSON(commandURL, session=None):
     # try to get corrent state of network relay
     response = None
 
+    if session is None:
+        session = requests
+
     try:
-        response = requests.get(commandURL)
+        response = session.get(commandURL, timeout=httpTimeout)
         resposeIsOk = 0
 
         response = response.json()
@@ -81,6 +129,7 @@ def httpResquestJSON(commandURL):
 def generateVarFunctionsNet(idx):
 
     port2Use = "80"
+    userData = ""
     if len(str(commandsAdv[u"devicePort"][idx])) > 0:
         port2Use = str(commandsAdv[u"devicePort"][idx])
 
@@ -132,69 +181,403 @@ def generateStatusFunctionNet(idx):
 
     return statusURL
 
+def resolve_device_address(deviceIP):
+    """Return the IP address of a device name, or the name if it cannot be resolved"""
+    try:
+        return socket.gethostbyname(deviceIP)
+    except socket.error:
+        return deviceIP
+
+def build_device_endpoints():
+    """Build the URLs of each network device once, and a session for each device host.
+    The device address is resolved here so pushed states are checked without DNS lookups."""
+    global deviceEndpoints
+
+    endpoints = {}
+    for i in range(len(commandsAdv[u"typeOutput"])):
+        if commandsAdv[u"typeOutput"][i] != "shellyHTTP" and commandsAdv[u"typeOutput"][i] != "sonOff":
+            continue
+
+        port2Use, userData, shellyChannel = generateVarFunctionsNet(i)
+        statusURL = generateStatusFunctionNet(i)
+        endpoints[i] = {
+            "status": statusURL,
+            "on": generateONFunctionNet(i),
+            "off": generateOFFFunctionNet(i),
+            "channel": int(shellyChannel),
+            "host": urlparse(statusURL).netloc,
+            "address": resolve_device_address(commandsAdv[u"deviceIP"][i]),
+        }
+
+        if endpoints[i]["host"] not in deviceSessions:
+            deviceSessions[endpoints[i]["host"]] = requests.Session()
+            deviceSessionLocks[endpoints[i]["host"]] = Lock()
+
+    deviceEndpoints = endpoints
+
+def device_request(i, action):
+    """Send the status, on or off request to network device i"""
+    endpoint = deviceEndpoints[i]
+    with deviceSessionLocks[endpoint["host"]]:
+        resposeIsOk, response = httpResquestJSON(endpoint[action], deviceSessions[endpoint["host"]])
+
+    if resposeIsOk != 0:
+        deviceErrors[i] = deviceErrors.get(i, 0) + 1
+        status_changed()
+
+    return resposeIsOk, response
+
+def status_changed():
+    """Wake up the status requests waiting for a change"""
+    global statusVersion
+
+    with statusCondition:
+        statusVersion += 1
+        statusCondition.notify_all()
+
+def set_relay_state(i, state):
+    """Save the last known relay state of network device i"""
+    lastTimeValvesOnLine[i] = datetime.datetime.now()
+
+    if relayStates.get(i) != state:
+        relayStates[i] = state
+        status_changed()
+
+def valve_status(i):
+    """Status of network device i for the dashboard"""
+    lastSeen = (datetime.datetime.now() - lastTimeValvesOnLine[i]).total_seconds()
+
+    pending = None
+    if i in latchDeviceJob:
+        pending = "latch"
+    elif i in valveWorkers:
+        state = valveWorkers[i].pending
+        if state is None:
+            state = valveWorkers[i].running
+        if state is not None:
+            pending = "on" if state else "off"
+
+    return {
+        "valveId": i,
+        "lastSeen": int(lastSeen),
+        "color": "red" if lastSeen > 1.5 * poll_interval() else "green",
+        "state": relayStates.get(i),
+        "pending": pending,
+        "errors": deviceErrors.get(i, 0),
+    }
+
+################################################################################
+# Device commands:                                                             #
+################################################################################
+
+def read_valve_state(i):
+    """Return the response code and the relay state of network device i"""
+    resposeIsOk, response = device_request(i, "status")
+    if resposeIsOk != 0:
+        return resposeIsOk, None
+
+    lastTimeValvesOnLine[i] = datetime.datetime.now()
+
+    try:
+        if commandsAdv[u"typeOutput"][i] == "shellyHTTP":
+            state = bool(response['relays'][deviceEndpoints[i]["channel"]]['ison'])
+        else:
+            state = response['data']['switch'] == 'on'
+    except (KeyError, IndexError, TypeError):
+        print("No data fount in respond")
+        return 4, None
+
+    set_relay_state(i, state)
+    return 0, state
+
+def apply_valve_state(i, state):
+    """Turn network device i on or off if it is not already in that state"""
+    resposeIsOk, lastState = read_valve_state(i)
+    if resposeIsOk != 0:
+        print("Valve", i + 1, "is not responding")
+        return False
+
+    if lastState == state:
+        print("Station is the correct state")
+        return True
+
+    if state:
+        print("Station ned to be on but it is turn of")
+        resposeIsOkCmd, response = device_request(i, "on")
+    else:
+        print("Station ned to be off but it is turn on")
+        resposeIsOkCmd, response = device_request(i, "off")
+
+    if resposeIsOkCmd != 0:
+        print("Unable to turn " + ("on" if state else "off"))
+        return False
+
+    resposeIsOk, newState = read_valve_state(i)
+    if resposeIsOk == 0 and newState == state:
+        print("Valve is now turn " + ("on" if state else "off"))
+        return True
+
+    print("Fail to turn " + ("on" if state else "off"))
+    return False
+
+class valve_worker(object):
+    """Send the commands of one network device, only the latest desired state is kept.
+    Latch pulse steps are run in the order they are due, before any desired state."""
+
+    def __init__(self, valveId):
+        self.valveId = valveId
+        self.pending = None
+        self.running = None
+        self.steps = deque()  # (job id, remaining steps) of latch pulses
+        self.condition = Condition()
+
+        self.thread = Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def set_state(self, state):
+        with self.condition:
+            self.pending = state
+            self.condition.notify()
+
+        status_changed()
+
+    def run_step(self, jobId, steps):
+        with self.condition:
+            self.steps.append((jobId, steps))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.steps:
+                    self.condition.wait()
+                if self.steps:
+                    jobId, steps = self.steps.popleft()
+                else:
+                    jobId = None
+            if jobId is not None:
+                latch_run_step(jobId, self.valveId, steps)
+                continue
+
+            with self.condition:
+                state = self.pending
+                self.pending = None
+                self.running = state
+
+            try:
+                with devicesAccessProtection[self.valveId]:
+                    apply_valve_state(self.valveId, state)
+            except Exception as e:
+                print("Fail to send command to valve", self.valveId + 1, e)
+
+            self.running = None
+            status_changed()
+
+def device_worker(i):
+    """Return the worker sending the commands of network device i"""
+    with valveWorkersLock:
+        if i not in valveWorkers:
+            valveWorkers[i] = valve_worker(i)
+
+        return valveWorkers[i]
+
+def set_desired_state(i, state):
+    """Set the state network device i must be in, sent by its worker"""
+    desiredStates[i] = state
+    device_worker(i).set_state(state)
+
 ################################################################################
 # Control functions:                                                           #
 ################################################################################
 
+def poll_interval():
+    """Seconds between status checks of each device"""
+    if commandsAdv.get(u"pushMode", 0) == 1:
+        return pushPollInterval
+
+    return pollInterval
+
+def keep_valve_state(i, state):
+    """Send network device i back to the desired state if keep state is used"""
+    if commandsAdv[u"useLatch"][i] == 0 and commandsAdv[u"deviceKeepState"][i] == 1:
+        desiredState = desiredStates.get(i, bool(gv.srvals[i]))
+        if state != desiredState:
+            print("Valve", i + 1, "is not in the station state")
+            set_desired_state(i, desiredState)
+
+def check_valve_on_line_keep_state(i):
+    """Check if network device i is on-line and if it is in the desired state.
+    Return "busy", "online" or "offline"."""
+
+    # a command is being sent to this device, skip this check
+    if not devicesAccessProtection[i].acquire(False):
+        return "busy"
+
+    try:
+        resposeIsOk, state = read_valve_state(i)
+    finally:
+        devicesAccessProtection[i].release()
+
+    if resposeIsOk != 0:
+        return "offline"
+
+    # if to keep state if not in the correct state change state
+    keep_valve_state(i, state)
+    return "online"
+
 def run_check_valves_on_line_keep_state():
-    global lastTimeValvesOnLine
+    """Check all network devices concurrently, each one every pollInterval seconds.
+    Off-line devices are checked less and less often, up to offlinePollMax seconds,
+    so they do not keep the workers waiting on timeouts."""
+    pool = ThreadPoolExecutor(max_workers=pollWorkers)
+    pending = {}
+    nextPoll = {}
+    offlineChecks = {}  # valve id -> failed checks in a row
 
     while runValveOnLine:
-        lastTime = datetime.datetime.now()
+        now = time.time()
 
         for i in range(len(gv.srvals)):
-            if commandsAdv[u"typeOutput"][i] == "shellyHTTP" or commandsAdv[u"typeOutput"][i] == "sonOff":
-                statusURL = generateStatusFunctionNet(i)
-
-                turnOffURL = generateOFFFunctionNet(i)
-                turnOnURL = generateONFunctionNet(i)
-
-                port2Use, userData, shellyChannel = generateVarFunctionsNet(i)
-
-                devicesAccessProtection[i].acquire()
-                resposeIsOk, response = httpResquestJSON(statusURL)
-
-                if resposeIsOk == 0:
-                    lastTimeValvesOnLine[i] = datetime.datetime.now()
-
-                # if to keep state if not in the correct state change state
-                if resposeIsOk == 0 and commandsAdv[u"useLatch"][i] == 0 and commandsAdv[u"deviceKeepState"][i] == 1:
-                    try:
-                        if commandsAdv[u"typeOutput"][i] == "shellyHTTP":
-                            newState = bool(response['relays'][int(shellyChannel)]['ison'])
-                        else:
-                            newState = response['data']['switch'] == 'on'
-
-                        if newState and gv.srvals[i] == 0:
-                            resposeIsOkOff, response = httpResquestJSON(turnOffURL)
-                            if resposeIsOkOff != 0:
-                                print("Fail to turn off in keep state")
-                        elif not newState and gv.srvals[i] == 1:
-                            resposeIsOkOn, response = httpResquestJSON(turnOnURL)
-                            if resposeIsOkOn != 0:
-                                print("Fail to turn on in keep state")
-                    except NameError:
-                        print("Error, no data found")
-
-                devicesAccessProtection[i].release()      
-
-        nowTime = datetime.datetime.now()
-
-        # read each valve after 30s
-        diffTime = nowTime - lastTime
-        lastTime = nowTime
-        secondsInt = int(diffTime.seconds)
-        if 30 - secondsInt > 0:
-            sleepTime = 30 - secondsInt
-            for k in range(sleepTime):
-                if not runValveOnLine:
-                    break
-                time.sleep(1)
+            if commandsAdv[u"typeOutput"][i] != "shellyHTTP" and commandsAdv[u"typeOutput"][i] != "sonOff":
+                continue
+
+            if i in pending:
+                if not pending[i].done():
+                    # device still answering or timing out, do not stack checks
+                    continue
+                try:
+                    checked = pending[i].result()
+                except Exception as e:
+                    print("Fail to check valve", i + 1, e)
+                    checked = "offline"
+                del pending[i]
+                if checked == "busy":
+                    # device was busy, try again soon
+                    nextPoll[i] = now + 1
+                elif checked == "offline":
+                    offlineChecks[i] = offlineChecks.get(i, 0) + 1
+                    nextPoll[i] = now + min(poll_interval() * 2 ** offlineChecks[i], offlinePollMax)
+                else:
+                    offlineChecks.pop(i, None)
+
+            if nextPoll.get(i, 0) <= now:
+                nextPoll[i] = now + poll_interval()
+                pending[i] = pool.submit(check_valve_on_line_keep_state, i)
+
+        time.sleep(1)
+
+    pool.shutdown(wait=True)
+
+################################################################################
+# Latch pulses:                                                                #
+################################################################################
+
+# Each step sends the requests to the valve and returns the seconds to wait
+# before the next step, or None if the pulse failed.
+
+def latch_step_online(i):
+    resposeIsOk, state = read_valve_state(i)
+    if resposeIsOk != 0:
+        return None
+
+    return 0
+
+def latch_step_off_if_on(i):
+    # Guaranty that valve is turn off
+    resposeIsOk, lastState = read_valve_state(i)
+    if resposeIsOk != 0:
+        print("Fail to check initial state")
+        return None
+
+    if not lastState:
+        return 0
+
+    resposeIsOkOff, response = device_request(i, "off")
+    if resposeIsOkOff != 0:
+        print("Fail to turn off for a while")
+        return None
+
+    return 2 * commandsAdv[u"latchDutyCicle"][i]
+
+def latch_step_on(i):
+    resposeIsOkOn, response = device_request(i, "on")
+    if resposeIsOkOn != 0:
+        return None
+
+    return commandsAdv[u"latchDutyCicle"][i]
+
+def latch_step_off(i):
+    resposeIsOkOff, response = device_request(i, "off")
+    if resposeIsOkOff != 0:
+        return None
+
+    print("Latch sucess")
+    return 0
+
+def latch_pulse(valveId, steps):
+    """Queue a latch pulse for a valve and return its job id"""
+    with latchCondition:
+        jobId = next(latchJobIds)
+        latchJobs[jobId] = {"valveId": valveId, "status": "waiting"}
+        latchDeviceJob[valveId] = jobId
+
+        # forget old finished jobs
+        for oldJob in sorted(latchJobs)[:-latchJobsKeep]:
+            if latchJobs[oldJob]["status"] in ("OK", "NOK"):
+                del latchJobs[oldJob]
+
+        heapq.heappush(latchQueue, (time.time(), jobId, valveId, steps))
+        latchCondition.notify()
+
+    status_changed()
+    return jobId
+
+def latch_job_done(jobId, valveId, status):
+    with latchCondition:
+        latchJobs[jobId]["status"] = status
+        if latchDeviceJob.get(valveId) == jobId:
+            del latchDeviceJob[valveId]
+
+    status_changed()
+
+def latch_run_step(jobId, valveId, steps):
+    """Send the first step of a latch pulse, run by the worker of the valve"""
+    try:
+        with devicesAccessProtection[valveId]:
+            delay = steps[0](valveId)
+    except Exception as e:
+        print("Latch error", valveId + 1, e)
+        delay = None
+
+    if delay is None:
+        latch_job_done(jobId, valveId, "NOK")
+    elif len(steps) == 1:
+        latch_job_done(jobId, valveId, "OK")
+    else:
+        with latchCondition:
+            heapq.heappush(latchQueue, (time.time() + delay, jobId, valveId, steps[1:]))
+            latchCondition.notify()
+
+def run_latch_pulses():
+    """Hand the steps of the latch pulses to the device workers when they are due"""
+    while True:
+        with latchCondition:
+            while not latchQueue or latchQueue[0][0] > time.time():
+                if latchQueue:
+                    latchCondition.wait(latchQueue[0][0] - time.time())
+                else:
+                    latchCondition.wait()
+
+            dueTime, jobId, valveId, steps = heapq.heappop(latchQueue)
+            latchJobs[jobId]["status"] = "running"
+
+        device_worker(valveId).run_step(jobId, steps)
 
 # Read in the commands for this plugin from it's JSON file
 def load_commands():
     global commandsAdv, devicesAccessProtection, lastTimeValvesOnLine
-    global runValveOnLine, threadCheckOnLine
+    global runValveOnLine, threadCheckOnLine, threadLatchPulses
 
     try:
         with open(u"./data/advance_control.json", u"r") as f:
@@ -212,13 +595,19 @@ def load_commands():
         with open(u"./data/advance_control.json", u"w") as f:
             json.dump(commandsAdv, f, indent=4)
 
-    devicesAccessProtection = [Lock()] * gv.sd[u"nst"]
+    devicesAccessProtection = [Lock() for i in range(gv.sd[u"nst"])]
+    build_device_endpoints()
     lastTimeValvesOnLine = [datetime.datetime.now()] * gv.sd[u"nst"]
 
     runValveOnLine = True
     threadCheckOnLine = Thread(target = run_check_valves_on_line_keep_state)
     threadCheckOnLine.start()
 
+    if threadLatchPulses is None:
+        threadLatchPulses = Thread(target = run_latch_pulses)
+        threadLatchPulses.daemon = True
+        threadLatchPulses.start()
+
     return
 
 
@@ -248,89 +637,13 @@ def on_zone_change(name, **kw):
                         if command:
                             subprocess.call(command.split(), shell=True)
                 elif commandsAdv[u"typeOutput"][i] == "shellyHTTP" or commandsAdv[u"typeOutput"][i] == "sonOff":
-                    statusURL = generateStatusFunctionNet(i)
-
-                    turnOffURL = generateOFFFunctionNet(i)
-                    turnOnURL = generateONFunctionNet(i)
-
-                    port2Use, userData, shellyChannel = generateVarFunctionsNet(i)
-
-                    #start to lock device to avoid same http requets
-                    devicesAccessProtection[i].acquire()
-
-                    resposeIsOk, response = httpResquestJSON(statusURL)
-
-                    if resposeIsOk == 0 and commandsAdv[u"useLatch"][i] == 0:
-                        lastTimeValvesOnLine[i] = datetime.datetime.now()
-
-                        try:
-                            if commandsAdv[u"typeOutput"][i] == "shellyHTTP":
-                                lastState = bool(response['relays'][int(shellyChannel)]['ison'])
-                            else:
-                                lastState = response['data']['switch'] == 'on'
-                        except NameError:
-                            print("No data fount in respond")
-                            resposeIsOk = 4
-
-                        if gv.srvals[i] and not lastState:  # station is off and new state must be on
-                            print("Station ned to be on but it is turn of")
-                            resposeIsOkOn, response = httpResquestJSON(turnOnURL)
-                            if resposeIsOkOn == 0:
-                                resposeIsOk, response = httpResquestJSON(statusURL)
-
-                                if resposeIsOk == 0:
-                                    try:
-                                        if commandsAdv[u"typeOutput"][i] == "shellyHTTP":
-                                            newState = bool(response['relays'][int(shellyChannel)]['ison'])
-                                        else:
-                                            newState = response['data']['switch'] == 'on'
-                                    except NameError:
-                                        print("No data fount in respond from turn on")
-                                        resposeIsOk = 5
-
-                                    if newState:
-                                        print("Valve is now turn on")
-                                    else:
-                                        resposeIsOk = 6
-                                        print("Fail to turn on")
-                            else:
-                                print("Unable to turn off")
-                        elif not gv.srvals[i] and lastState: #station is turn on but must turn off
-                            print("Station ned to be off but it is turn on")
-                            resposeIsOkOn, response = httpResquestJSON(turnOffURL)
-                            if resposeIsOkOn:
-                                resposeIsOk, response = httpResquestJSON(statusURL)
-
-                                if resposeIsOk == 0:
-                                    try:
-                                        if commandsAdv[u"typeOutput"][i] == "shellyHTTP":
-                                            newState = bool(response['relays'][0]['ison'])
-                                        else:
-                                            newState = response['data']['switch'] == 'on'
-                                    except NameError:
-                                        print("No data fount in respond from turn on")
-                                        resposeIsOk = 5
-
-                                    if not newState:
-                                        print("Valve is now turn off")
-                                    else:
-                                        resposeIsOk = 6
-                                        print("Fail to turn off")
-                            else:
-                                print("Unable to turn off")
-                        else:
-                            print("Station is the correct state")
-                    elif commandsAdv[u"useLatch"][i] == 1 and resposeIsOk == 0:
-                        # use lactch and valve is online
+                    if commandsAdv[u"useLatch"][i] == 1:
+                        # use lactch, pulse is sent by the latch worker
                         print("use latch")
-                        resposeIsOkOn, response = httpResquestJSON(turnOnURL)
-                        time.sleep(commandsAdv[u"latchDutyCicle"][i])
-                        if resposeIsOkOn == 0:
-                            resposeIsOkOff, response = httpResquestJSON(turnOffURL)
-                            if resposeIsOkOff:
-                                print("Latch sucess")
+                        latch_pulse(i, [latch_step_online, latch_step_on, latch_step_off])
+                        continue
 
-                    devicesAccessProtection[i].release()
+                    set_desired_state(i, bool(gv.srvals[i]))
 
         priorAdv = gv.srvals[:]
     return
@@ -378,8 +691,8 @@ def check_commands_advance_size():
             commandsAdv[u"on"].extend(increase)
             commandsAdv[u"off"].extend(increase)
 
-            increaseProtection = [Lock()] * (gv.sd[u"nst"] - len(commandsAdv[u"on"]))
-            devicesAccessProtection.extend()
+            increaseProtection = [Lock() for i in range(gv.sd[u"nst"] - len(devicesAccessProtection))]
+            devicesAccessProtection.extend(increaseProtection)
         elif gv.sd[u"nst"] < len(commandsAdv[u"on"]):
             commandsAdv[u"typeOutput"] = commandsAdv[u"typeOutput"][: gv.sd[u"nst"]]
 
@@ -401,6 +714,8 @@ def check_commands_advance_size():
 
             devicesAccessProtection = devicesAccessProtection[: gv.sd[u"nst"]]
 
+        build_device_endpoints()
+
 class settings(ProtectedPage):
     """Load an html page for entering advance_control commands"""
 
@@ -468,6 +783,11 @@ class update(ProtectedPage):
             commandsAdv[u"on"][i] = qdict[u"con" + str(i)]
             commandsAdv[u"off"][i] = qdict[u"coff" + str(i)]
 
+        if u"pushMode" in qdict:
+            commandsAdv[u"pushMode"] = 1
+        else:
+            commandsAdv[u"pushMode"] = 0
+
         if u"gpio" in qdict:
             commandsAdv[u"gpio"] = 1
             gv.use_gpio_pins = False
@@ -508,15 +828,43 @@ class check_valve_status(ProtectedPage):
 
                 diff = timeNow - lastSeen
 
-                if diff.seconds > 45:
+                if diff.total_seconds() > 1.5 * poll_interval():
                     return "red"
                 else:
                     return "green"
 
         return "white"
 
+class check_valve_status_all(ProtectedPage):
+    """Status of all network valves in JSON format
+
+    With ?version=N waits until the status is different from version N.
+    """
+
+    def GET(self):
+        qdict = web.input()
+
+        if "version" in qdict:
+            try:
+                version = int(qdict["version"])
+            except ValueError:
+                version = None
+
+            endTime = time.time() + statusWaitTimeout
+            with statusCondition:
+                while statusVersion == version and time.time() < endTime:
+                    statusCondition.wait(endTime - time.time())
+
+        valves = []
+        for i in range(min(gv.sd[u"nst"], len(commandsAdv[u"typeOutput"]))):
+            if commandsAdv[u"typeOutput"][i] == "shellyHTTP" or commandsAdv[u"typeOutput"][i] == "sonOff":
+                valves.append(valve_status(i))
+
+        web.header(u"Content-Type", u"application/json")
+        return json.dumps({"version": statusVersion, "valves": valves})
+
 class valve_latch_send_signal(ProtectedPage):
-    """Send valve latch signal"""
+    """Send valve latch signal, returns the job id of the pulse"""
 
     def GET(self):
         qdict = web.input()
@@ -525,58 +873,55 @@ class valve_latch_send_signal(ProtectedPage):
 
             if valveId >= 0 and valveId < gv.sd[u"nst"]:
                 if commandsAdv[u"typeOutput"][valveId] == "shellyHTTP" or commandsAdv[u"typeOutput"][valveId] == "sonOff":
-                    if devicesAccessProtection[valveId].locked():
-                        # already lock, avoid multy test in the same time
+                    if valveId in latchDeviceJob:
+                        # already sending a pulse, avoid multy test in the same time
                         return "Waitting"
 
-                    statusURL = generateStatusFunctionNet(valveId)
-
-                    turnOffURL = generateOFFFunctionNet(valveId)
-                    turnOnURL = generateONFunctionNet(valveId)
-
-                    port2Use, userData, shellyChannel = generateVarFunctionsNet(valveId)
-
-                    devicesAccessProtection[valveId].acquire()
-
-                    # Guaranty that valve is turn off
-                    resposeIsOk, response = httpResquestJSON(statusURL)
-                    if resposeIsOk != 0:
-                        print("Fail to check initial state")
-                        devicesAccessProtection[valveId].release()
-                        return "NOK"
-
-                    try:
-                        if commandsAdv[u"typeOutput"][valveId] == "shellyHTTP":
-                            lastState = bool(response['relays'][int(shellyChannel)]['ison'])
-                        else:
-                            lastState = response['data']['switch'] == 'on'
-                    except NameError:
-                        print("No data fount in respond")
-                        devicesAccessProtection[valveId].release()
-                        return "NOK"
-
-                    # if relay is on, turn off for a while to send latch signal
-                    if lastState:
-                        resposeIsOkOff, response = httpResquestJSON(turnOffURL)
-                        time.sleep(2 * commandsAdv[u"latchDutyCicle"][valveId])
-
-                        if resposeIsOkOff == 0:
-                            print("Fail to turn off for a while")
-                            devicesAccessProtection[valveId].release()
-                            return "NOK"
-
-                    resposeIsOkOn, response = httpResquestJSON(turnOnURL)
-                    if resposeIsOkOn == 0:
-                        time.sleep(commandsAdv[u"latchDutyCicle"][valveId])
-                        resposeIsOkOff, response = httpResquestJSON(turnOffURL)
-                        if resposeIsOkOff == 0:
-                            devicesAccessProtection[valveId].release()
-                            return "OK"
-                        else:
-                            devicesAccessProtection[valveId].release()
-                            return "NOK"
-                    else:
-                        devicesAccessProtection[valveId].release()
-                        return "NOK"
+                    # if relay is on, turn off for a while before the latch signal
+                    return str(latch_pulse(valveId, [latch_step_off_if_on, latch_step_on, latch_step_off]))
                 else:
-                    return "NOK"
\ No newline at end of file
+                    return "NOK"
+
+        return "NOK"
+
+class valve_push_state(object):
+    """Relay state sent by the device, ex: Shelly action URL /advpush?valveId=0&state=on"""
+
+    def GET(self):
+        qdict = web.input()
+        try:
+            valveId = int(qdict["valveId"])
+            state = qdict["state"] == "on"
+        except (KeyError, ValueError):
+            return "NOK"
+
+        if valveId < 0 or valveId >= gv.sd[u"nst"] or commandsAdv.get(u"pushMode", 0) != 1:
+            return "NOK"
+
+        if commandsAdv[u"typeOutput"][valveId] != "shellyHTTP" and commandsAdv[u"typeOutput"][valveId] != "sonOff":
+            return "NOK"
+
+        # only accept the state from the device itself
+        if valveId not in deviceEndpoints or web.ctx.ip != deviceEndpoints[valveId]["address"]:
+            return "NOK"
+
+        set_relay_state(valveId, state)
+        keep_valve_state(valveId, state)
+
+        return "OK"
+
+class latch_job_status(ProtectedPage):
+    """Status of a latch pulse job: waiting, running, OK or NOK"""
+
+    def GET(self):
+        qdict = web.input()
+        try:
+            jobId = int(qdict["jobId"])
+        except (KeyError, ValueError):
+            return "NOK"
+
+        with latchCondition:
+            if jobId in latchJobs:
+                return latchJobs[jobId]["status"]
+
+        return "NOK"
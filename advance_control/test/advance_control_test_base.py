@@ -0,0 +1,23 @@
+import os
+import sys
+import tempfile
+
+# Insert test directories and this plugin's directory
+TEST_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, TEST_DIR)
+STUB_DIR = os.path.join(TEST_DIR, "stubs")
+sys.path.insert(0, STUB_DIR)
+ADVANCE_CONTROL_DIR = os.path.realpath(os.path.join(TEST_DIR, '..'))
+sys.path.insert(0, ADVANCE_CONTROL_DIR)
+# Load stubbed-out components for advance_control
+sys.modules['web'] = __import__('stub_web')
+sys.modules['gv'] = __import__('stub_gv')
+sys.modules['urls'] = __import__('stub_urls')
+sys.modules['sip'] = __import__('stub_sip')
+sys.modules['webpages'] = __import__('stub_webpages')
+sys.modules['blinker'] = __import__('stub_blinker')
+
+# The plugin reads and writes ./data/advance_control.json when loaded
+DATA_DIR = tempfile.mkdtemp()
+os.makedirs(os.path.join(DATA_DIR, "data"))
+os.chdir(DATA_DIR)
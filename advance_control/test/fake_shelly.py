@@ -0,0 +1,37 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeShelly:
+    """Local HTTP server answering the Shelly requests used by advance_control"""
+
+    def __init__(self):
+        self.relay_on = False
+        self.requests = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fake.requests.append(self.path)
+                if "turn=on" in self.path:
+                    fake.relay_on = True
+                elif "turn=off" in self.path:
+                    fake.relay_on = False
+                body = json.dumps({"relays": [{"ison": fake.relay_on}]}).encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
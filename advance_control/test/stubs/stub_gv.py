@@ -0,0 +1,5 @@
+plugin_menu = []
+now = 0
+sd = {u"nst": 2, u"nbrd": 1}
+srvals = [0] * 2
+snames = [u"S01", u"S02"]
@@ -0,0 +1,9 @@
+from types import SimpleNamespace
+
+ctx = SimpleNamespace(ip="127.0.0.1")
+
+def input(*args, **kwargs):
+    pass
+
+def seeother(*args, **kwargs):
+    pass
@@ -0,0 +1,95 @@
+import os
+import threading
+import time
+import unittest
+from unittest.mock import patch
+# This will stub sip things out
+import advance_control_test_base
+# Now that things have been stubbed out, advance_control may be imported
+import advance_control
+import web
+from fake_shelly import FakeShelly
+
+# Stop the status checks started when the plugin is loaded
+advance_control.runValveOnLine = False
+advance_control.threadCheckOnLine.join()
+os.chdir(advance_control_test_base.TEST_DIR)
+
+
+class PushTestCase(unittest.TestCase):
+    def setUp(self):
+        self.shelly = FakeShelly()
+        self.commands = patch.dict(advance_control.commandsAdv, {
+            u"typeOutput": [u"shellyHTTP", u""],
+            u"deviceModel": [u"shelly1", u""],
+            u"deviceIP": [u"127.0.0.1", u""],
+            u"deviceProtocol": [u"http", u"http"],
+            u"devicePort": [str(self.shelly.port), u"80"],
+            u"deviceUserName": [u"", u""],
+            u"devicePassword": [u"", u""],
+            u"deviceKeepState": [0, 0],
+            u"useLatch": [0, 0],
+            u"pushMode": 1,
+        })
+        self.commands.start()
+        advance_control.build_device_endpoints()
+        advance_control.relayStates.clear()
+
+    def tearDown(self):
+        self.commands.stop()
+        self.shelly.stop()
+
+    def push(self, ip, valveId="0", state="on"):
+        web.ctx.ip = ip
+        with patch("web.input", return_value={"valveId": valveId, "state": state}, create=True):
+            return advance_control.valve_push_state().GET()
+
+
+class TestValvePushState(PushTestCase):
+    def test_push_from_device(self):
+        self.assertEqual(self.push("127.0.0.1"), "OK")
+        self.assertTrue(advance_control.relayStates[0])
+        self.assertEqual(self.push("127.0.0.1", state="off"), "OK")
+        self.assertFalse(advance_control.relayStates[0])
+
+    def test_push_from_other_host(self):
+        self.assertEqual(self.push("10.0.0.9"), "NOK")
+        self.assertNotIn(0, advance_control.relayStates)
+
+    def test_push_resolved_once(self):
+        advance_control.commandsAdv[u"deviceIP"][0] = u"localhost"
+        advance_control.build_device_endpoints()
+        # No DNS lookup when the device pushes its state
+        with patch("socket.gethostbyname", side_effect=AssertionError("DNS lookup")):
+            self.assertEqual(self.push("127.0.0.1"), "OK")
+
+    def test_push_invalid(self):
+        self.assertEqual(self.push("127.0.0.1", valveId="1"), "NOK")
+        self.assertEqual(self.push("127.0.0.1", valveId="9"), "NOK")
+        self.assertEqual(self.push("127.0.0.1", valveId="x"), "NOK")
+        advance_control.commandsAdv[u"pushMode"] = 0
+        self.assertEqual(self.push("127.0.0.1"), "NOK")
+
+
+class TestPollFallback(PushTestCase):
+    def test_poll_reads_unpushed_change(self):
+        # The relay changed but the device did not push it
+        self.shelly.relay_on = True
+        with patch("advance_control.pushPollInterval", 1):
+            advance_control.runValveOnLine = True
+            thread = threading.Thread(target=advance_control.run_check_valves_on_line_keep_state)
+            thread.start()
+            try:
+                deadline = time.time() + 5
+                while not advance_control.relayStates.get(0) and time.time() < deadline:
+                    time.sleep(0.1)
+            finally:
+                advance_control.runValveOnLine = False
+                thread.join()
+
+        self.assertTrue(advance_control.relayStates.get(0))
+        self.assertIn("/status", self.shelly.requests)
+
+
+if __name__ == '__main__':
+    unittest.main()
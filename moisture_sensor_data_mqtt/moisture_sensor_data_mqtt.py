@@ -12,11 +12,23 @@ from urls import urls  # Get access to SIP's URLs
 import web  # web.py framework
 from webpages import ProtectedPage  # Needed for security
 
+import array
 import datetime
 import copy
 import os
+import shutil
+import sys
+import threading
 from plugins import mqtt
 
+try:
+    # Storage installed by the Simple Chart or Schedule Data Collector plugin
+    sys.path.insert(0, "./plugins/segmented_storage_helpers")
+    import segmented_storage
+except ImportError:
+    print("Segmented storage not installed, sensor readings stored in plain files")
+    segmented_storage = None
+
 try:
     import jmespath
 except ImportError:
@@ -28,7 +40,8 @@ except ImportError:
 # fmt: off
 urls.extend([
     u"/moisture_sensor_data_mqtt", u"plugins.moisture_sensor_data_mqtt.get_settings",
-    u"/moisture_sensor_data_mqtt-save", u"plugins.moisture_sensor_data_mqtt.save_settings"
+    u"/moisture_sensor_data_mqtt-save", u"plugins.moisture_sensor_data_mqtt.save_settings",
+    u"/moisture_sensor_data_mqtt-query", u"plugins.moisture_sensor_data_mqtt.query_readings"
     ])
 # fmt: on
 
@@ -38,6 +51,19 @@ gv.plugin_menu.append([_("Moisture Sensor Data MQTT"), "/moisture_sensor_data_mq
 settings = {}
 last_reading = {}
 mqtt_readers = {}
+# Sensor settings parsed for mqtt_reader, topic -> list of sensors
+sensors_by_topic = {}
+# Recent readings of each sensor, sensor -> ReadingRing
+recent_readings = {}
+# Readings kept in memory for each sensor
+RING_SIZE = 288
+# Range of the values kept in memory (int32)
+VALUE_MIN = -(2 ** 31)
+VALUE_MAX = 2 ** 31 - 1
+# Stored readings loaded into memory at startup, in seconds
+RING_LOAD_PERIOD = 86400
+# Readings used for the trend sent with the moisture_sensor_data signal
+TREND_READINGS = 6
 SENSOR_DATA_PATH = "./static/data/moisture_sensor_data"
 CONFIG_FILE_PATH = "./data/moisture_sensor_data_mqtt.json"
 ATTRIBUTES = [
@@ -71,14 +97,182 @@ def validate_int_list(int_list):
 
 
 def create_sensor_data_file(new_file):
-    """Use x and y as headings for the graph plugin"""
-    with open(new_file, "w") as f:
-        f.write("x,y\n")
+    """Create the segmented series of a sensor for the graph plugin. The
+    sensor names are also read from the data directory by other plugins.
+    Without the storage module a plain CSV file is used, with x and y as
+    headings.
+    """
+    if segmented_storage is not None:
+        segmented_storage.open_series(new_file)
+    elif not os.path.exists(new_file):
+        with open(new_file, "w") as f:
+            f.write("x,y\n")
+
+
+def remove_sensor_data_file(old_file):
+    if segmented_storage is not None and segmented_storage.is_series(old_file):
+        segmented_storage.open_series(old_file).delete()
+    elif os.path.isdir(old_file):
+        shutil.rmtree(old_file, ignore_errors=True)
+    elif os.path.isfile(old_file):
+        os.remove(old_file)
+
+
+def rename_sensor_data_file(old_file, new_file):
+    if segmented_storage is not None and segmented_storage.is_series(old_file):
+        segmented_storage.open_series(old_file).rename(new_file)
+    else:
+        os.rename(old_file, new_file)
+
+
+class ReadingRing:
+    """Fixed size ring of the most recent (timestamp, value) readings of a
+    sensor, kept in arrays so readers do not need the data files.
+    """
+
+    def __init__(self, size=RING_SIZE):
+        self.size = size
+        self.timestamps = array.array("q", [0] * size)
+        self.values = array.array("i", [0] * size)
+        self.count = 0
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def append(self, timestamp, value):
+        # Readings outside the driest/wettest range can be far from 0-100%
+        value = max(VALUE_MIN, min(VALUE_MAX, value))
+        with self.lock:
+            self.timestamps[self.next] = timestamp
+            self.values[self.next] = value
+            self.next = (self.next + 1) % self.size
+            self.count = min(self.count + 1, self.size)
+
+    def readings(self, since=None, last=None):
+        """Return the (timestamp, value) readings in time order, optionally
+        only those after since or only the last ones.
+        """
+        with self.lock:
+            count = self.count if last is None else min(last, self.count)
+            start = self.next - count
+            readings = [
+                (self.timestamps[i % self.size], self.values[i % self.size])
+                for i in range(start, self.next)
+            ]
+
+        if since is not None:
+            readings = [r for r in readings if r[0] > since]
+        return readings
+
+    def trend(self, last=TREND_READINGS):
+        """Return the slope (% per hour) of the last readings using a
+        least squares fit, or None if there are not enough readings.
+        """
+        readings = self.readings(last=last)
+        if len(readings) < 2:
+            return None
+
+        mean_ts = sum(r[0] for r in readings) / len(readings)
+        mean_value = sum(r[1] for r in readings) / len(readings)
+        variance = sum((r[0] - mean_ts) ** 2 for r in readings)
+        if variance == 0:
+            return None
+
+        covariance = sum((r[0] - mean_ts) * (r[1] - mean_value) for r in readings)
+        return round(covariance / variance * 3600, 2)
+
+
+def load_recent_readings(sensor_name):
+    """Fill the ring of a sensor from its stored readings"""
+    ring = ReadingRing()
+    recent_readings[sensor_name] = ring
+
+    sensor_file = f"{SENSOR_DATA_PATH}/{sensor_name}"
+    since = (int(gv.now) - RING_LOAD_PERIOD) * 1000
+    if segmented_storage is not None and segmented_storage.is_series(sensor_file):
+        lines = segmented_storage.open_series(sensor_file).read(since)
+    elif os.path.isfile(sensor_file):
+        with open(sensor_file, "r") as f:
+            # Skip headers
+            f.readline()
+            lines = f.readlines()
+    else:
+        return
+
+    for line in lines[-RING_SIZE:]:
+        fields = line.split(",")
+        try:
+            timestamp_ms = int(float(fields[0]))
+            if timestamp_ms >= since:
+                ring.append(timestamp_ms // 1000, int(fields[1]))
+        except (ValueError, IndexError, OverflowError):
+            continue
+
+
+def compile_sensors():
+    """Parse the sensor settings once for mqtt_reader: index the sensors
+    by topic, compile the jmespath expressions and validate the numeric
+    attributes. Sensors missing a required attribute are skipped.
+    """
+    global sensors_by_topic
+
+    by_topic = {}
+    for sensor_name, setting in settings["sensors"].items():
+        if "topic" not in setting or setting["topic"] == "":
+            continue
+
+        interval, driest, wettest, retention = validate_int_list(
+            [
+                setting.get("interval"),
+                setting.get("driest"),
+                setting.get("wettest"),
+                setting.get("retention"),
+            ]
+        )
+
+        if driest is None or wettest is None or driest == wettest:
+            continue
+
+        # Parse the specific path for this sensor
+        path = setting.get("path", "")
+        expression = None
+        if path != "":
+            try:
+                expression = jmespath.compile(path)
+            except Exception as e:
+                print(f"Invalid jmespath expression for {sensor_name}: {path}, {e}")
+                continue
+
+        # Save reading data for graph plugin if retention specified.
+        series = None
+        data_file = None
+        if retention is not None and retention != 0:
+            sensor_file = f"{SENSOR_DATA_PATH}/{sensor_name}"
+            if segmented_storage is not None:
+                if segmented_storage.is_series(sensor_file):
+                    series = segmented_storage.open_series(sensor_file)
+            elif os.path.isfile(sensor_file):
+                data_file = sensor_file
+
+        by_topic.setdefault(setting["topic"], []).append(
+            {
+                "name": sensor_name,
+                "expression": expression,
+                "interval": None
+                if interval is None
+                else datetime.timedelta(minutes=interval),
+                "driest": driest,
+                "wettest": wettest,
+                "series": series,
+                "data_file": data_file,
+            }
+        )
+
+    sensors_by_topic = by_topic
 
 
 def mqtt_reader(client, msg):
     """Sensor callback function for MQTT subscribe. Matches the topic
-    back to the sensor in order to access additional
+    back to the sensors in order to access additional
     attributes. Parses the message payload for an integer value. If
     the optional path attribute is set then jmsepath is used to parse
     an integer from the payload. This value is then converted to a
@@ -86,16 +280,9 @@ def mqtt_reader(client, msg):
     stores it in the senors' data file.
 
     """
-    global settings
-
     # Get sensors matching this topic
-    matching_sensors = [
-        k
-        for k, v in settings["sensors"].items()
-        if "topic" in v and v["topic"] == msg.topic
-    ]
-
-    if len(matching_sensors) == 0:
+    matching_sensors = sensors_by_topic.get(msg.topic)
+    if not matching_sensors:
         return
 
     # Parse the payload once (same for all sensors)
@@ -105,48 +292,37 @@ def mqtt_reader(client, msg):
         print("mqtt_reader could not decode payload: ", msg.payload, e)
         return
 
+    ts_secs = int(gv.now)
+    ts = datetime.datetime.fromtimestamp(ts_secs)
+
     # Process EACH sensor that matches this topic
-    for sensor_name in matching_sensors:
-        setting = settings["sensors"][sensor_name]
-        sensor_file = f"{SENSOR_DATA_PATH}/{sensor_name}"
+    for sensor in matching_sensors:
+        sensor_name = sensor["name"]
 
-        # Parse the specific path for this sensor
-        path = setting["path"]
-        if path != "":
+        if sensor["expression"] is not None:
             try:
-                raw_reading = jmespath.search(path, raw_payload)
+                raw_reading = sensor["expression"].search(raw_payload)
             except Exception as e:
-                print(f"mqtt_reader found invalid jmespath expression for {sensor_name}: {path}, {e}")
+                print(f"mqtt_reader could not apply jmespath expression for {sensor_name}: {e}")
                 continue
         else:
             raw_reading = raw_payload
 
-        reading, interval, driest, wettest, retention = validate_int_list(
-            [
-                raw_reading,
-                setting["interval"],
-                setting["driest"],
-                setting["wettest"],
-                setting["retention"],
-            ]
-        )
+        (reading,) = validate_int_list([raw_reading])
 
         if reading is None:
             print(f"mqtt_reader did not find integer for {sensor_name}: {raw_reading}")
             continue
 
-        if driest is None or wettest is None:
-            continue
-
-        ts_secs = int(gv.now)
-        ts = datetime.datetime.fromtimestamp(ts_secs)
-        if interval is not None and sensor_name in last_reading:
-            if last_reading[sensor_name]["ts"] + datetime.timedelta(minutes=interval) > ts:
+        if sensor["interval"] is not None and sensor_name in last_reading:
+            if last_reading[sensor_name]["ts"] + sensor["interval"] > ts:
                 continue
 
         #
         # Convert reading to %
         #
+        driest = sensor["driest"]
+        wettest = sensor["wettest"]
         if driest < wettest:
             reading = (reading - driest) / (wettest - driest) * 100
         else:
@@ -156,15 +332,24 @@ def mqtt_reader(client, msg):
         # Store reading for display purposes
         last_reading[sensor_name] = {"ts": ts, "reading": reading}
 
-        # Send msd signal
-        msd_signal.send(
-            "reading", data={"sensor": sensor_name, "timestamp": ts_secs, "value": reading}
-        )
+        if sensor_name not in recent_readings:
+            recent_readings[sensor_name] = ReadingRing()
+        ring = recent_readings[sensor_name]
+        ring.append(ts_secs, reading)
+
+        # Send msd signal, with the trend (% per hour) when known
+        data = {"sensor": sensor_name, "timestamp": ts_secs, "value": reading}
+        trend = ring.trend()
+        if trend is not None:
+            data["trend"] = trend
+        msd_signal.send("reading", data=data)
 
         # Save reading data for graph plugin if retention specified.
         # Note the timestamp is in milliseconds!
-        if retention is not None and retention != 0 and os.path.isfile(sensor_file):
-            with open(sensor_file, "a") as f:
+        if sensor["series"] is not None:
+            sensor["series"].append([(ts_secs * 1000, reading)])
+        elif sensor["data_file"] is not None:
+            with open(sensor["data_file"], "a") as f:
                 f.write(f"{ts_secs * 1000},{reading}\n")
 
 
@@ -201,50 +386,50 @@ def stop_mqtt_reader(sensor_name):
 
 def truncate_data_files(neme, **kw):
     """Remove readings from data files that are past the retention
-    period. Only process files once a week to save disk IO. Store that
-    last truncate timestamp as the new_day signal is also sent on
-    startup.
+    period. Readings are stored in weekly segments and only whole
+    segments are deleted, so this is cheap enough to run on every
+    new_day signal (also sent on startup). Plain CSV files, used when
+    the storage module is missing, are rewritten.
     """
-    last_truncate = settings.get("last_truncate", int(gv.now))
-
-    # Only perform truncation once a week to limit IO?
-    if last_truncate + (86400 * 7) > gv.now:
-        return
-
-    settings["last_truncate"] = int(gv.now)
-    with open(CONFIG_FILE_PATH, "w") as f:
-        f.write(json.dumps(settings, indent=2))
-
     for sensor in settings["sensors"].keys():
         sensor_file = f"{SENSOR_DATA_PATH}/{sensor}"
-        sensor_file_tmp = f"/tmp/{sensor}.tmp"
+        (retention,) = validate_int_list([settings["sensors"][sensor]["retention"]])
+        if retention is None:
+            retention = 0
 
-        if os.path.isfile(sensor_file):
-            (retention,) = validate_int_list([settings["sensors"][sensor]["retention"]])
-            if retention is None:
-                retention = 0
+        # Convert days/seconds to miliseconds
+        cutoff = (int(gv.now) - retention * 86400) * 1000
 
-            # Convert days/seconds to miliseconds
-            retention = retention * 86400 * 1000
-            now = int(gv.now) * 1000
+        if segmented_storage is not None and segmented_storage.is_series(sensor_file):
+            segmented_storage.open_series(sensor_file).expire(cutoff)
+        elif os.path.isfile(sensor_file):
+            truncate_plain_file(sensor_file, cutoff)
 
-            with open(sensor_file, "r") as input:
-                with open(sensor_file_tmp, "w") as output:
-                    # Copy headers straight to output
-                    output.write(input.readline())
 
-                    for line in input:
-                        fields = line.split(",")
-                        # timestamp can be float or int
-                        if int(float(fields[0])) + retention > now:
-                            output.write(line)
+def truncate_plain_file(sensor_file, cutoff):
+    """Remove the readings older than cutoff from a plain CSV file"""
+    sensor_file_tmp = f"{sensor_file}.tmp"
 
-            try:
-                # Best option as new sensor data my be being written to file
-                os.replace(sensor_file_tmp, sensor_file)
-            except OSError as e:
-                print(f"Cannot replace {sensor_file}", e)
-                os.remove(sensor_file_tmp)
+    with open(sensor_file, "r") as input:
+        with open(sensor_file_tmp, "w") as output:
+            # Copy headers straight to output
+            output.write(input.readline())
+
+            for line in input:
+                fields = line.split(",")
+                try:
+                    # timestamp can be float or int
+                    if int(float(fields[0])) >= cutoff:
+                        output.write(line)
+                except ValueError:
+                    continue
+
+    try:
+        # Best option as new sensor data my be being written to file
+        os.replace(sensor_file_tmp, sensor_file)
+    except OSError as e:
+        print(f"Cannot replace {sensor_file}", e)
+        os.remove(sensor_file_tmp)
 
 
 def load_moisture_data_mqtt_settings():
@@ -258,7 +443,6 @@ def load_moisture_data_mqtt_settings():
         # If file does not exist return default value
         settings = {
             "sensors": {},
-            "last_truncate": int(gv.now),
         }
 
 
@@ -273,8 +457,9 @@ def moisture_sensor_data_init():
 
     for sensor in settings["sensors"].keys():
         sensor_file = f"{SENSOR_DATA_PATH}/{sensor}"
-        if not os.path.isfile(sensor_file):
-            create_sensor_data_file(sensor_file)
+        # Also converts data files of older versions to segments
+        create_sensor_data_file(sensor_file)
+        load_recent_readings(sensor)
 
         # Only subscribe once per unique topic
         setting = settings["sensors"][sensor]
@@ -284,6 +469,8 @@ def moisture_sensor_data_init():
                 mqtt.subscribe(topic, mqtt_reader, qos=0)
                 subscribed_topics.add(topic)
 
+    compile_sensors()
+
 
 class get_settings(ProtectedPage):
     """
@@ -351,14 +538,14 @@ class save_settings(ProtectedPage):
                     stop_mqtt_reader(old_sensor)
                     msd_signal.send("delete", data={"sensor": f"{old_sensor}"})
                     last_reading.pop(old_sensor, None)
-                    if os.path.isfile(old_file):
-                        # missing_ok=True
-                        os.remove(old_file)
+                    recent_readings.pop(old_sensor, None)
+                    remove_sensor_data_file(old_file)
 
             elif new_sensor != old_sensor:
                 if old_sensor == "":
                     # Case: New sensor
                     create_sensor_data_file(new_file)
+                    recent_readings[new_sensor] = ReadingRing()
                     msd_signal.send("add", data={"sensor": f"{new_sensor}"})
                     create_mqtt_reader(new_setting)
                 else:
@@ -369,10 +556,12 @@ class save_settings(ProtectedPage):
                         "rename",
                         data={"sensor": f"{new_sensor}", "old_sensor": f"{old_sensor}"},
                     )
-                    if os.path.isfile(old_file) and not os.path.isfile(new_file):
-                        os.rename(old_file, new_file)
+                    if os.path.exists(old_file) and not os.path.exists(new_file):
+                        rename_sensor_data_file(old_file, new_file)
                     if old_sensor in last_reading:
                         last_reading[new_sensor] = last_reading.pop(old_sensor)
+                    if old_sensor in recent_readings:
+                        recent_readings[new_sensor] = recent_readings.pop(old_sensor)
 
             else:
                 if updated:
@@ -390,10 +579,40 @@ class save_settings(ProtectedPage):
         with open(CONFIG_FILE_PATH, "w") as f:
             f.write(json.dumps(settings, indent=2))
 
+        compile_sensors()
+
         # Redisplay the plugin page
         raise web.seeother("/moisture_sensor_data_mqtt")
 
 
+class query_readings(ProtectedPage):
+    """
+    Return the recent readings of a sensor from memory as JSON. The
+    optional since value (seconds) only returns newer readings.
+    """
+
+    def GET(self):
+        qdict = web.input(sensor="", since=None)
+
+        if qdict.sensor not in recent_readings:
+            raise web.notfound()
+
+        try:
+            since = int(qdict.since) if qdict.since else None
+        except ValueError:
+            raise web.badrequest()
+
+        ring = recent_readings[qdict.sensor]
+        web.header("Content-Type", "application/json")
+        return json.dumps(
+            {
+                "sensor": qdict.sensor,
+                "readings": ring.readings(since),
+                "trend": ring.trend(),
+            }
+        )
+
+
 msd_signal = signal("moisture_sensor_data")
 
 new_day_signal = signal("new_day")
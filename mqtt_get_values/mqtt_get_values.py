@@ -9,7 +9,10 @@ __author__ = "Modified from mqtt_zones originally written by Daniel Casner"
 from __future__ import print_function
 
 # standard library imports
+import hashlib
 import json  # for working with data file
+import threading
+import time
 
 # local module imports
 from blinker import signal  # To receive station notifications
@@ -30,7 +33,18 @@ urls.extend(
     ]
 )
 # fmt: on
-gv.plugin_menu.append([$_(u"MQTT Get Values Plugin"), u"/mqtt_get_values-sp"])
+gv.plugin_menu.append([_(u"MQTT Get Values Plugin"), u"/mqtt_get_values-sp"])
+
+CPU_TEMP_TTL = 60  # seconds a CPU temperature reading is reused
+DEBOUNCE_DELAY = 0.5  # seconds to collect a burst of value changes
+
+_cpu_temp = None
+_cpu_temp_time = 0
+_wl_keys = []  # water level adjustment keys (wl_*) in gv.sd
+_wl_keys_count = 0  # len(gv.sd) when _wl_keys was built
+_last_hash = None
+_publish_timer = None
+_lock = threading.Lock()
 
 
 class settings(ProtectedPage):
@@ -62,8 +76,25 @@ class save_settings(ProtectedPage):
         raise web.seeother(u"/")  # Return user to home page.
 
 
-### System settings ###
-def notify_value_change(name, **kw):
+def cpu_temp():
+    """Return CPU temperature, read at most once per CPU_TEMP_TTL seconds"""
+    global _cpu_temp, _cpu_temp_time
+    if _cpu_temp is None or time.time() - _cpu_temp_time >= CPU_TEMP_TTL:
+        _cpu_temp = get_cpu_temp()
+        _cpu_temp_time = time.time()
+    return _cpu_temp
+
+
+def wl_keys():
+    """Return water level adjustment keys, rescanned when gv.sd keys are added or removed"""
+    global _wl_keys, _wl_keys_count
+    if len(gv.sd) != _wl_keys_count:
+        _wl_keys = [entry for entry in gv.sd if entry.startswith(u"wl_")]
+        _wl_keys_count = len(gv.sd)
+    return _wl_keys
+
+
+def build_snapshot():
     payload = {
         u"devt": gv.now,
         u"nbrd": gv.sd[u"nbrd"],
@@ -77,19 +108,46 @@ def notify_value_change(name, **kw):
         u"sbits": gv.sbits,
         u"ps": gv.ps,
         u"lrun": gv.lrun,
-        u"ct": get_cpu_temp(),
+        u"ct": cpu_temp(),
         u"tu": gv.sd[u"tu"]
     }
     # for plugin compatibility read all water level adjustment settings (wl_*)
-    for entry in gv.sd:
-        if entry.startswith(u"wl_"):
-            payload[entry] = gv.sd[entry]
+    for entry in wl_keys():
+        payload[entry] = gv.sd[entry]
+    return payload
+
+
+def publish_snapshot():
+    """Publish system values unless unchanged since the last publish"""
+    global _last_hash, _publish_timer
+    with _lock:
+        _publish_timer = None
+    payload = build_snapshot()
+    # devt changes every second, compare the other values only
+    values = dict(payload)
+    del values[u"devt"]
+    digest = hashlib.sha1(json.dumps(values, sort_keys=True).encode(u"utf-8")).digest()
+    if digest == _last_hash:
+        return
 
     get_values_topic = mqtt.get_settings().get(u"get_values_topic")
     if get_values_topic:
         client = mqtt.get_client()
         if client:
             client.publish(get_values_topic, json.dumps(payload), qos=1, retain=True)
+            _last_hash = digest
+
+
+### System settings ###
+def notify_value_change(name, **kw):
+    """Publish once after a burst of value changes"""
+    global _publish_timer
+    with _lock:
+        if _publish_timer:
+            return
+        _publish_timer = threading.Timer(DEBOUNCE_DELAY, publish_snapshot)
+        _publish_timer.daemon = True
+        _publish_timer.start()
 
 
 value = signal(u"value_change")
@@ -5,11 +5,15 @@
 from __future__ import print_function
 
 # standard library imports
+from contextlib import contextmanager
+import hashlib  # for discovery payload hashes
 import json  # for working with data file
+import time
 import uuid
 import re
 import slugify as unicode_slug  # python-slugify package
 import socket
+import threading
 
 
 # local module imports
@@ -41,9 +45,17 @@ HASS_ON = u"On"
 HASS_OFF = u"Off"
 
 HASS_MQTT_DATA_FILE = u"./data/mqtt_hass.json"
+HASS_MQTT_DISCOVERY_FILE = u"./data/mqtt_hass_discovery.json"
 MQTT_HASS_DISCOVERY_TOPIC_PREFIX = u"homeassistant"
 MQTT_HASS_SYSTEM_NAME_DEFAULT = u"sip"
 MQTT_HASS_SYSTEM_ENABLE_SUB_TOPIC = u"/system/enable"
+MQTT_HASS_ZONES_SUB_TOPIC = u"/zones"
+ZONE_STATE_ATTRIBUTES = [u"state", u"start_time", u"duration", u"program"]
+MQTT_HASS_DISCOVERY_BURST = 10  # Discovery publishes before pausing
+MQTT_HASS_DISCOVERY_PAUSE = 0.2  # Pause in seconds between discovery bursts
+MQTT_HASS_INIT_WAIT = 1  # Seconds between MQTT connection checks at startup
+MQTT_HASS_INIT_BATCH = 8  # Zones published per batch at startup
+MQTT_HASS_RAIN_DELAY_THROTTLE = 60  # Minimum seconds between rain delay timer publishes
 
 # Base MQTT settings
 BASE_MQTT_BROKER_HOST = u"broker_host"
@@ -62,6 +74,8 @@ MQTT_HASS_DEVICE_IS_STATION_NAME = u"hass_device_is_station_name"
 MQTT_HASS_DEVICE_IS_STATION_NAM_DEFAULT = HASS_OFF
 MQTT_HASS_PUB_DISABLED = u"hass_pub_disabled"
 MQTT_HASS_PUB_DISABLED_DEFAULT = HASS_OFF
+MQTT_HASS_ZONE_AGGREGATE = u"hass_zone_aggregate"
+MQTT_HASS_ZONE_AGGREGATE_DEFAULT = HASS_OFF
 MQTT_HASS_UUID = u"hass_uuid"
 MQTT_HASS_UUID_DEFAULT = u"sip_uuid"
 
@@ -70,6 +84,9 @@ _settings = {}
 _settings_stored = {}
 _settings_base_mqtt = {}
 _sip_web_url = u""
+_discovery_hashes = {}  # Discovery topic -> hash of last published payload
+_discovery_hashes_changed = False
+_discovery_burst_count = 0
 
 
 # Helper functions
@@ -219,8 +236,13 @@ class save_settings(ProtectedPage):
             HASS_ON if MQTT_HASS_DEVICE_IS_STATION_NAME in qdict else HASS_OFF
         )
 
+        qdict[MQTT_HASS_ZONE_AGGREGATE] = (
+            HASS_ON if MQTT_HASS_ZONE_AGGREGATE in qdict else HASS_OFF
+        )
+
         _settings_stored.update(qdict)
         write_settings()
+        clear_discovery_hashes()  # Submit always republishes all discovery configs
         hass.notify_mqtt_hass_settings_change()  # process new plugin settings
         raise web.seeother(u"/")  # Return user to home page.
 
@@ -245,6 +267,50 @@ def read_settings():
     return
 
 
+def read_discovery_hashes():
+    global _discovery_hashes
+    try:
+        with open(HASS_MQTT_DISCOVERY_FILE, u"r") as f:
+            _discovery_hashes = json.load(f)
+    except (IOError, ValueError):
+        _discovery_hashes = {}
+
+
+def write_discovery_hashes():
+    """Save discovery payload hashes if any changed since last save"""
+    global _discovery_hashes_changed
+    if not _discovery_hashes_changed:
+        return
+    try:
+        with open(HASS_MQTT_DISCOVERY_FILE, u"w") as f:
+            json.dump(_discovery_hashes, f, indent=4, sort_keys=True)
+        _discovery_hashes_changed = False
+    except IOError as e:
+        print(u"MQTT HASS Plugin couldn't write discovery file:", e)
+
+
+def clear_discovery_hashes():
+    """Forget published discovery payloads so they are all published again"""
+    global _discovery_hashes_changed
+    _discovery_hashes.clear()
+    _discovery_hashes_changed = True
+
+
+def discovery_hash(payload):
+    """Return a stable hash of a discovery payload"""
+    data = json.dumps(payload, sort_keys=True).encode(u"utf-8")
+    return hashlib.sha1(data).hexdigest()
+
+
+def discovery_burst_pause():
+    """Pause after every burst of discovery publishes to spread large republishes"""
+    global _discovery_burst_count
+    _discovery_burst_count += 1
+    if _discovery_burst_count >= MQTT_HASS_DISCOVERY_BURST:
+        _discovery_burst_count = 0
+        time.sleep(MQTT_HASS_DISCOVERY_PAUSE)
+
+
 # MQTT HASS base class
 class mqtt_hass_base:
     """
@@ -491,13 +557,27 @@ class mqtt_hass_base:
         return payload
 
     def discovery_publish(self, force_enable=False):
-        """Publish MQTT HASS Discovery config to HASS"""
+        """
+        Publish MQTT HASS Discovery config to HASS
+        Skip payloads identical to the last one published on the same topic
+        """
+        global _discovery_hashes_changed
         payload = self.discovery_payload()
+        digest = discovery_hash(payload)
+        if _discovery_hashes.get(self.discovery_topic) == digest:
+            return
         self._publish(self.discovery_topic, payload)
+        if mqtt.is_connected():
+            _discovery_hashes[self.discovery_topic] = digest
+            _discovery_hashes_changed = True
+        discovery_burst_pause()
 
     def discovery_unpublish(self, force_enable=False):
         """Remove MQTT HASS Discovery config"""
+        global _discovery_hashes_changed
         self._publish(self.discovery_topic)
+        if _discovery_hashes.pop(self.discovery_topic, None):
+            _discovery_hashes_changed = True
 
     def state_topic_get(self):
         """Return entity state MQTT topic"""
@@ -596,6 +676,7 @@ class mqtt_hass_system_param(mqtt_hass_base):
         max=None,
         unit=None,
         gv_sd=None,
+        throttle=None,
     ):
         super().__init__(
             name=name,
@@ -611,6 +692,59 @@ class mqtt_hass_system_param(mqtt_hass_base):
         if self._component == u"binary_sensor":
             self._options = {HASS_OFF: 0, HASS_ON: 1}
 
+        # Minimum seconds between state publishes, None publishes every change
+        self._throttle = throttle
+        self._throttle_last = 0
+        self._throttle_timer = None
+        self._throttle_lock = threading.Lock()
+
+    def state_publish(self, force_enable=False, force_update=False):
+        """
+        Publish system value if updated
+        Throttled parameters publish at most once per throttle interval.
+        The latest value is always published when the interval ends.
+        force = True will republish the value immediately
+        """
+        if self._throttle and not force_update:
+            if self.get_sip_value() == self._value:
+                return
+            with self._throttle_lock:
+                if self._throttle_timer:
+                    return  # Latest value published when the timer fires
+                wait = self._throttle_last + self._throttle - time.time()
+                if wait > 0:
+                    self._throttle_timer = threading.Timer(wait, self._throttle_publish)
+                    self._throttle_timer.daemon = True
+                    self._throttle_timer.start()
+                    return
+                self._throttle_last = time.time()
+        elif self._throttle:
+            with self._throttle_lock:
+                if self._throttle_timer:
+                    self._throttle_timer.cancel()
+                    self._throttle_timer = None
+                self._throttle_last = time.time()
+        self.state_value_publish(force_update=force_update)
+
+    def _throttle_publish(self):
+        """Publish the latest value at the end of the throttle interval"""
+        with self._throttle_lock:
+            self._throttle_timer = None
+            self._throttle_last = time.time()
+        self.state_value_publish()
+
+    def state_value_publish(self, force_update=False):
+        """Publish system value if updated"""
+        super().state_publish(force_update=force_update)
+
+    def state_unpublish(self, force_enable=False):
+        """Cancel pending throttled publish and remove state from the MQTT broker"""
+        with self._throttle_lock:
+            if self._throttle_timer:
+                self._throttle_timer.cancel()
+                self._throttle_timer = None
+        super().state_unpublish(force_enable)
+
     def set_sip_value(self, value):
         """Set SIP setting according to direct value or key name in option{}"""
         if self._component == u"number":
@@ -670,7 +804,8 @@ class mqtt_hass_system_param(mqtt_hass_base):
             return
 
         self.set_sip_value(value)
-        self.state_publish()
+        # Echo values set from HASS right away, bypassing the throttle
+        self.state_publish(force_update=True)
 
 
 class mqtt_hass_rain_delay_timer(mqtt_hass_system_param):
@@ -685,6 +820,7 @@ class mqtt_hass_rain_delay_timer(mqtt_hass_system_param):
             min=0,
             max=24,
             unit=u"h",
+            throttle=MQTT_HASS_RAIN_DELAY_THROTTLE,
         )
         self._sd_param = u"rd"
         self._json_state = True
@@ -699,7 +835,7 @@ class mqtt_hass_rain_delay_timer(mqtt_hass_system_param):
             gv.sd[u"rdst"] = int(gv.now + gv.sd[self._sd_param] * 3600)
             stop_onrain()
 
-    def state_publish(self, force_update=False):
+    def state_value_publish(self, force_update=False):
         """
         Publish system value if updated
         force = True will republish the value
@@ -741,6 +877,109 @@ class mqtt_hass_running_program(mqtt_hass_system_param):
         return sip_program_to_name(gv.pon)
 
 
+# MQTT HASS aggregated zone states
+class mqtt_hass_zone_states:
+    """
+    MQTT HASS aggregated zone states
+    All zones share one JSON state document, keyed by zone number, and one
+    wildcard subscription for set messages dispatched by zone number
+    """
+
+    def __init__(self):
+        self._documents = {}  # State topic -> {zone key: zone state}
+        self._callbacks = {}  # Set topic prefix -> {zone key: callback}
+        self._changed = set()  # State topics waiting for publish
+        self._batch = 0
+        self._lock = threading.RLock()
+
+    def _publish(self, topic):
+        """Publish a state document or clear it when empty"""
+        client = mqtt.get_client()
+        if client:
+            document = self._documents.get(topic)
+            payload = json.dumps(document, sort_keys=True) if document else u""
+            client.publish(topic, payload, qos=1, retain=True)
+
+    def _changed_publish(self):
+        """Publish all changed state documents unless a batch is in progress"""
+        if self._batch:
+            return
+        for topic in self._changed:
+            self._publish(topic)
+            if not self._documents.get(topic):
+                self._documents.pop(topic, None)
+        self._changed.clear()
+
+    @contextmanager
+    def batch(self):
+        """Publish changed state documents once at the end of the outermost batch"""
+        with self._lock:
+            self._batch += 1
+            try:
+                yield
+            finally:
+                self._batch -= 1
+                self._changed_publish()
+
+    def state_set(self, topic, key, values):
+        """Update zone state attributes in the state document"""
+        with self._lock:
+            state = self._documents.setdefault(topic, {}).setdefault(key, {})
+            if all(state.get(k) == v for k, v in values.items()):
+                return
+            state.update(values)
+            self._changed.add(topic)
+            self._changed_publish()
+
+    def state_remove(self, topic, key, attributes=None):
+        """Remove a zone, or some zone attributes, from the state document"""
+        with self._lock:
+            document = self._documents.get(topic, {})
+            if key not in document:
+                return
+            if attributes is None:
+                del document[key]
+            else:
+                state = document[key]
+                if not any(k in state for k in attributes):
+                    return
+                for k in attributes:
+                    state.pop(k, None)
+                if not state:
+                    del document[key]
+            self._changed.add(topic)
+            self._changed_publish()
+
+    def subscribe(self, topic, key, callback):
+        """Dispatch set messages received on topic to the zone callback"""
+        prefix = topic.rsplit(u"/", 1)[0]
+        with self._lock:
+            if prefix not in self._callbacks:
+                self._callbacks[prefix] = {}
+                mqtt.subscribe(prefix + u"/#", self.set_incoming_message)
+            self._callbacks[prefix][key] = callback
+
+    def unsubscribe(self, topic, key):
+        """Stop dispatching set messages to the zone"""
+        prefix = topic.rsplit(u"/", 1)[0]
+        with self._lock:
+            callbacks = self._callbacks.get(prefix, {})
+            callbacks.pop(key, None)
+            if prefix in self._callbacks and not callbacks:
+                del self._callbacks[prefix]
+                mqtt.unsubscribe(prefix + u"/#", self.set_incoming_message)
+
+    def set_incoming_message(self, client, msg):
+        """Dispatch MQTT set message to the zone matching the last topic level"""
+        prefix, _, key = msg.topic.rpartition(u"/")
+        callback = self._callbacks.get(prefix, {}).get(key)
+        if callback:
+            callback(client, msg)
+
+
+_zone_states = mqtt_hass_zone_states()
+
+
 # MQTT HASS zone class
 class mqtt_hass_zone(mqtt_hass_base):
     """
@@ -750,6 +989,11 @@ class mqtt_hass_zone(mqtt_hass_base):
 
     def __init__(self, index):
         self._index = index
+        self._key = u"{0:02d}".format(index + 1)
+        self._aggregate = (
+            _settings.get(MQTT_HASS_ZONE_AGGREGATE, MQTT_HASS_ZONE_AGGREGATE_DEFAULT)
+            == HASS_ON
+        )
         self._enable = self._get_enable_option()
         self._json_state = True
         super().__init__(
@@ -760,6 +1004,8 @@ class mqtt_hass_zone(mqtt_hass_base):
             icon=u"mdi:water",
         )
         self._json_state = True
+        # Reverse lookup of option name by SIP zone state
+        self._option_names = {state: value for value, state in self._options.items()}
 
     def _publish_disabled(self, force_enable=False):
         """
@@ -813,22 +1059,18 @@ class mqtt_hass_zone(mqtt_hass_base):
 
     def get_sip_value(self):
         """Return SIP zone state name according to options"""
-        sip_state = gv.srvals[self._index]
-        for value, state in self._options.items():
-            if state == sip_state:
-                return value
-        return None
+        return self._option_names.get(gv.srvals[self._index])
 
     def device_name(self):
         """Return zone Device name"""
         if _settings[MQTT_HASS_DEVICE_IS_STATION_NAME] == HASS_ON:
             return super().device_name() + u" - " + self._name
         else:
-            return super().device_name() + u" Z" + u"{0:02d}".format(self._index + 1)
+            return super().device_name() + u" Z" + self._key
 
     def device_uid(self):
         """Return zone Device UID"""
-        return self._system_UID() + "_Z" + "{0:02d}".format(self._index + 1)
+        return self._system_UID() + "_Z" + self._key
 
     def entity_name(self):
         """Return zone switch Entity name"""
@@ -837,18 +1079,24 @@ class mqtt_hass_zone(mqtt_hass_base):
 
     def entity_uid(self):
         """Return zone Entity UID"""
-        return self._system_UID() + "_Z" + "{0:02d}".format(self._index + 1)
+        return self._system_UID() + "_Z" + self._key
 
     def discovery_payload(self):
         """Return zone HASS Discovery configuration attributes"""
         payload = super().discovery_payload()
-        payload["availability"].append(
-            {
-                "topic": self.state_topic + u"/availability",
-                "payload_available": u"online",
-                "payload_not_available": u"offline",
-            }
-        )
+        availability = {
+            "topic": self.availability_topic,
+            "payload_available": u"online",
+            "payload_not_available": u"offline",
+        }
+        if self._aggregate:
+            availability["value_template"] = (
+                u"{{ value_json['" + self._key + u"'].availability }}"
+            )
+            payload[u"json_attributes_template"] = (
+                u"{{ value_json['" + self._key + u"'] | tojson }}"
+            )
+        payload["availability"].append(availability)
         payload["device"]["via_device"] = self._system_UID()
         return payload
 
@@ -866,7 +1114,15 @@ class mqtt_hass_zone(mqtt_hass_base):
 
     def state_topic_get(self):
         """Return zone MQTT state topic"""
-        return _settings[MQTT_HASS_TOPIC] + "/zone/" + "{0:02d}".format(self._index + 1)
+        if self._aggregate:
+            return _settings[MQTT_HASS_TOPIC] + MQTT_HASS_ZONES_SUB_TOPIC
+        return _settings[MQTT_HASS_TOPIC] + "/zone/" + self._key
+
+    def state_value_template(self):
+        """Return zone state decoding template"""
+        if self._aggregate:
+            return u"{{ value_json['" + self._key + u"'].state }}"
+        return super().state_value_template()
 
     def state_publish(self, force_enable=False, force_update=False):
         """
@@ -898,16 +1154,27 @@ class mqtt_hass_zone(mqtt_hass_base):
             u"duration": duration,
             u"program": program,
         }
-        self._publish(self.state_topic, payload)
+        if self._aggregate:
+            _zone_states.state_set(self.state_topic, self._key, payload)
+        else:
+            self._publish(self.state_topic, payload)
 
     def state_unpublish(self, force_enable=False):
         """Remove zone state from MQTT broker"""
         if self._publish_disabled(force_enable):
             return
-        super().state_unpublish()
+        if self._aggregate:
+            # Availability shares the zone entry and is kept
+            _zone_states.state_remove(
+                self.state_topic, self._key, ZONE_STATE_ATTRIBUTES
+            )
+        else:
+            super().state_unpublish()
 
     def availability_topic_get(self):
         """Return zone availability topic"""
+        if self._aggregate:
+            return self.state_topic_get()
         return self.state_topic_get() + "/availability"
 
     def availability_publish(self, force_enable=False):
@@ -916,25 +1183,48 @@ class mqtt_hass_zone(mqtt_hass_base):
             return
 
         payload = "online" if self._get_enable_option() else "offline"
-        self._publish(self.availability_topic, payload)
+        if self._aggregate:
+            _zone_states.state_set(
+                self.availability_topic, self._key, {u"availability": payload}
+            )
+        else:
+            self._publish(self.availability_topic, payload)
 
     def availability_unpublish(self, force_enable=False):
         """Remove zone availability from MQTT broker"""
         if self._publish_disabled(force_enable):
             return
-        self._publish(self.availability_topic)
+        if self._aggregate:
+            _zone_states.state_remove(
+                self.availability_topic, self._key, [u"availability"]
+            )
+        else:
+            self._publish(self.availability_topic)
+
+    def set_topic_get(self):
+        """Return zone set topic"""
+        if self._aggregate:
+            return self.state_topic_get() + u"/set/" + self._key
+        return super().set_topic_get()
 
     def set_subscribe(self, force_enable=False):
         """Listen to zone state change requests"""
         if self._publish_disabled(force_enable):
             return
-        super().set_subscribe()
+        if self._aggregate:
+            _zone_states.subscribe(self.set_topic, self._key, self.set_incoming_message)
+        else:
+            super().set_subscribe()
 
     def set_unsubscribe(self, force_enable=False):
         """Stop listening to zone state change requests"""
         if self._publish_disabled(force_enable):
             return
-        super().set_unsubscribe()
+        if self._aggregate:
+            _zone_states.unsubscribe(self.set_topic, self._key)
+            self._publish(self.set_topic)  # Clear set topic
+        else:
+            super().set_unsubscribe()
 
     def set_incoming_message(self, client, msg):
         """Process MQTT received zone set messages."""
@@ -985,9 +1275,27 @@ class mqtt_hass_to_sip:
     """MQTT HASS plugin SIP integration"""
 
     def __init__(self):
-        """Initialize MQTT HASS plugin components"""
+        """
+        Initialize MQTT HASS plugin components
+        Publishing to the MQTT broker starts in background once connected
+        """
         self._system = {}
         self._zone = {}
+        self._srvals = []  # Zone states at last zone_change notification
+        self._ready = False  # Notifications are ignored until initialized
+        self._settings_missed = False  # Settings changed while initializing
+
+        # Settings page is available while initializing
+        read_settings()
+
+        self._init_thread = threading.Thread(target=self.init_task, daemon=True)
+        self._init_thread.start()
+
+    def init_task(self):
+        """Wait for the base MQTT plugin connection then initialize and publish entities"""
+        while not mqtt.is_connected():
+            time.sleep(MQTT_HASS_INIT_WAIT)
+        print(u"MQTT HASS: Connected to broker, publishing entities")
 
         # Init base mqtt settings
         self.apply_base_mqtt_settings(init=True)
@@ -1001,6 +1309,19 @@ class mqtt_hass_to_sip:
         # Init zones
         self.zone_init()
 
+        write_discovery_hashes()
+        self._ready = True
+
+        # Catch up with changes notified while initializing
+        if self._settings_missed:
+            self.apply_hass_settings()
+            self.notify_system_settings_change(u"mqtt_hass")
+        self.notify_system_options_change(u"mqtt_hass")
+        self.notify_rain_change(u"mqtt_hass")
+        self.notify_running_program_change(u"mqtt_hass")
+        self.notify_zone_states_change(u"mqtt_hass")
+        print(u"MQTT HASS: Initialization completed")
+
     def apply_base_mqtt_settings(self, init=False):
         """Initialize MQTT HASS plugin options from saved setting in mqtt_hass.json"""
         global _settings_base_mqtt
@@ -1012,6 +1333,7 @@ class mqtt_hass_to_sip:
             if not init:
                 self.system_discovery_publish()
                 self.zone_discovery_publish()
+                write_discovery_hashes()
 
     def apply_hass_settings(self, init=False):
         """Initialize MQTT HASS plugin options from saved setting in mqtt_hass.json"""
@@ -1021,6 +1343,20 @@ class mqtt_hass_to_sip:
 
         if init:
             read_settings()
+            read_discovery_hashes()
+
+        # Zones are rebuilt when switching aggregated zone states mode
+        zone_aggregate = _settings_stored.get(
+            MQTT_HASS_ZONE_AGGREGATE, MQTT_HASS_ZONE_AGGREGATE_DEFAULT
+        )
+        zone_aggregate_change = (
+            MQTT_HASS_ZONE_AGGREGATE in _settings
+            and zone_aggregate != _settings[MQTT_HASS_ZONE_AGGREGATE]
+        )
+        if zone_aggregate_change:
+            self.zone_stop_publish()
+            self._zone = {}
+        _settings[MQTT_HASS_ZONE_AGGREGATE] = zone_aggregate
 
         if init and MQTT_HASS_UUID not in _settings_stored:
             _settings_stored[MQTT_HASS_UUID] = hex(uuid.getnode())
@@ -1061,7 +1397,11 @@ class mqtt_hass_to_sip:
         )
 
         self.system_update_settings()
-        self.zone_update_settings(force_enable)
+        if zone_aggregate_change:
+            self.zone_init()
+        else:
+            self.zone_update_settings(force_enable)
+        write_discovery_hashes()
 
     # System parameters - helper functions
     def system_init(self):
@@ -1151,27 +1491,42 @@ class mqtt_hass_to_sip:
             self._zone[k].discovery_publish()
 
     def zone_start_publish(self):
-        """Start publishing zones state change to MQTT"""
-        for k in self._zone.keys():
-            self._zone[k].start_publish(force_update=True)
+        """Start publishing zones state change to MQTT by batches of zones"""
+        keys = list(self._zone.keys())
+        for i in range(0, len(keys), MQTT_HASS_INIT_BATCH):
+            with _zone_states.batch():
+                for k in keys[i : i + MQTT_HASS_INIT_BATCH]:
+                    self._zone[k].start_publish(force_update=True)
+            print(
+                u"MQTT HASS: Published {0}/{1} zones".format(
+                    min(i + MQTT_HASS_INIT_BATCH, len(keys)), len(keys)
+                )
+            )
 
     def zone_stop_publish(self):
         """Stop publishing and clear zone state to MQTT"""
-        for k in self._zone.keys():
-            self._zone[k].stop_publish()
+        with _zone_states.batch():
+            for k in self._zone.keys():
+                self._zone[k].stop_publish()
 
     def zone_update_settings(self, force_enable):
         """Stop publishing and clear zone state to MQTT"""
-        for k in self._zone.keys():
-            self._zone[k].update_settings(force_enable)
+        with _zone_states.batch():
+            for k in self._zone.keys():
+                self._zone[k].update_settings(force_enable)
 
     # Handle system signaling - changes coming from SIP
     def notify_mqtt_hass_settings_change(self):
         """Handle MQTT HASS plugin options changed (from Web page)"""
+        if not self._ready:
+            self._settings_missed = True
+            return
         self.apply_hass_settings()
 
     def notify_base_mqtt_settings_change(self, name, **kw):
         """Handle base MQTT plugin options changed (from Web page)"""
+        if not self._ready:
+            return  # Base MQTT settings are read at initialization
         self.apply_base_mqtt_settings()
 
     def notify_system_settings_change(self, name, **kw):
@@ -1180,6 +1535,10 @@ class mqtt_hass_to_sip:
         global _settings
         global _sip_web_url
 
+        if not self._ready:
+            self._settings_missed = True
+            return
+
         # System name changed -> adjust MQTT topic and HASS name prefix
         _settings[MQTT_HASS_TOPIC] = mqtt_hass_get_setting(
             _settings_stored, key=MQTT_HASS_TOPIC, slugify=True
@@ -1194,19 +1553,20 @@ class mqtt_hass_to_sip:
         # Number of zones changed
         nb_zones_new = gv.sd[u"nst"]
         nb_zones = len(self._zone)
-        if nb_zones_new < nb_zones:
-            for k in range(nb_zones_new, nb_zones):
-                if k in self._zone:
-                    self._zone[k].stop_publish()
-                    del self._zone[k]
-        elif nb_zones_new > nb_zones:
-            for k in range(nb_zones, nb_zones_new):
-                self._zone[k] = mqtt_hass_zone(k)
-                self._zone[k].start_publish()
-
-        # For all remaining zones
-        for k in range(0, min(nb_zones_new, nb_zones)):
-            self._zone[k].update_settings()
+        with _zone_states.batch():
+            if nb_zones_new < nb_zones:
+                for k in range(nb_zones_new, nb_zones):
+                    if k in self._zone:
+                        self._zone[k].stop_publish()
+                        del self._zone[k]
+            elif nb_zones_new > nb_zones:
+                for k in range(nb_zones, nb_zones_new):
+                    self._zone[k] = mqtt_hass_zone(k)
+                    self._zone[k].start_publish()
+
+            # For all remaining zones
+            for k in range(0, min(nb_zones_new, nb_zones)):
+                self._zone[k].update_settings()
 
         # For all system settings zones
         for k in self._system.keys():
@@ -1214,33 +1574,58 @@ class mqtt_hass_to_sip:
 
         # Rain sensor logic
         self._system[u"rain_sensor_enable"].start_publish()
+        write_discovery_hashes()
 
     def notify_system_options_change(self, name, **kw):
         """Handle SIP options from main web page"""
+        if not self._ready:
+            return
         for k in [u"enable", u"mode", u"rain_delay_timer", u"water_level_adjust"]:
             self._system[k].state_publish()
 
     def notify_rain_change(self, name, **kw):
         """Handle Rain sensor state change"""
+        if not self._ready:
+            return
         self._system[u"rain_detect"].state_publish()
 
     def notify_rain_delay_change(self, name, **kw):
         """Handle Rain delay timer change from main web page"""
+        if not self._ready:
+            return
         self._system[u"rain_delay_timer"].state_publish()
 
     def notify_running_program_change(self, name, **kw):
         """Handle Running program number change"""
+        if not self._ready:
+            return
         self._system[u"running_program"].state_publish()
 
     def notify_zones_options_change(self, name, **kw):
         """Handle Station names changed in gv.snames[nb_zones]"""
-        for k in self._zone.keys():
-            self._zone[k].update_options()
+        if not self._ready:
+            return
+        with _zone_states.batch():
+            for k in self._zone.keys():
+                self._zone[k].update_options()
+        write_discovery_hashes()
 
     def notify_zone_states_change(self, name, **kw):
-        """Handle Zone(s) state changed"""
-        for k in self._zone.keys():
-            self._zone[k].state_publish()
+        """
+        Handle Zone(s) state changed
+        Only zones whose state differs from the previous notification are published
+        """
+        if not self._ready:
+            return
+        srvals = list(gv.srvals)
+        previous = self._srvals
+        self._srvals = srvals
+        with _zone_states.batch():
+            for k, state in enumerate(srvals):
+                if k < len(previous) and previous[k] == state:
+                    continue
+                if k in self._zone:
+                    self._zone[k].state_publish()
 
     def notify_restart_before(self, name, **kw):
         """Handle System shutdown"""
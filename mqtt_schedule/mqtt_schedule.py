@@ -8,7 +8,12 @@ __author__ = "Daniel Casner <daniel@danielcasner.org>"
 from __future__ import print_function
 
 # standard library imports
+import heapq
+import itertools
 import json  # for working with data file
+import math
+import threading
+import time
 
 # local module imports
 from blinker import signal  # To receive station notifications
@@ -31,6 +36,12 @@ urls.extend(
 # fmt: on
 gv.plugin_menu.append([u"MQTT scheduler", u"/mr1-sp"])
 
+_station_index = {}  # Station name -> station index
+_queue = []  # Heap of timed run once (start time, order, run once values)
+_queue_order = itertools.count()
+_queue_cv = threading.Condition()
+QUEUE_MAX_AHEAD = 3 * 86400  # Latest start accepted for a queued run once, in seconds
+
 
 class settings(ProtectedPage):
     """
@@ -61,17 +72,20 @@ class save_settings(ProtectedPage):
         raise web.seeother(u"/")  # Return user to home page.
 
 
-def on_message(client, msg):
-    """Callback when MQTT message is received."""
-    if not gv.sd[u"en"]:  # check operation status
-        return
-    num_brds = gv.sd[u"nbrd"]
-    num_sta = num_brds * 8
-    try:
-        cmd = json.loads(msg.payload)
-    except ValueError as e:
-        print(u"MQTT Schedule could not decode command: ", msg.payload, e)
-        return
+def update_station_index(name=None, **kw):
+    """Rebuild station name to index map when station names change."""
+    global _station_index
+    index = {}
+    for i, sname in enumerate(gv.snames):
+        index.setdefault(sname, i)  # first station wins like list.index()
+    _station_index = index
+
+
+def station_values(cmd, num_sta, strict=False):
+    """
+    Return run once values from a list or a dict of station names.
+    Return None if cmd is not valid, strict also rejects unknown stations.
+    """
     if type(cmd) is list:
         if len(cmd) < num_sta:
             print(
@@ -91,23 +105,27 @@ def on_message(client, msg):
             rovals = cmd
     elif type(cmd) is dict:
         rovals = [0] * num_sta
-        for k, v in list(cmd.items()):
-            if k not in gv.snames:
+        for k, v in cmd.items():
+            i = _station_index.get(k)
+            if i is None or i >= num_sta:
                 print(u"MQTT schedule, no station named:", k)
+                if strict:
+                    return None
             else:
-                rovals[gv.snames.index(k)] = v
+                rovals[i] = v
     else:
-        print(u"MQTT schedule unexpected command: ", msg.payload)
-        return
+        return None
+    return rovals
+
+
+def run_once(rovals):
+    """Start a run once program, replacing the current schedule."""
     if any(rovals):
         print(u"MQTT schedule:", rovals)
         gv.rovals = rovals
-        stations = [0] * num_brds
-        gv.ps = []  # program schedule (for display)
-        gv.rs = []  # run schedule
-        for i in range(gv.sd[u"nst"]):
-            gv.ps.append([0, 0])
-            gv.rs.append([0, 0, 0, 0])
+        stations = [0] * gv.sd[u"nbrd"]
+        gv.ps = [[0, 0] for i in range(gv.sd[u"nst"])]  # program schedule (for display)
+        gv.rs = [[0, 0, 0, 0] for i in range(gv.sd[u"nst"])]  # run schedule
         for i, v in enumerate(gv.rovals):
             if v:  # if this element has a value
                 gv.rs[i][0] = gv.now
@@ -119,6 +137,81 @@ def on_message(client, msg):
         schedule_stations(stations)
 
 
+def queue_batch(cmd, num_sta):
+    """
+    Validate all timed run once of a batch command then queue them together.
+    Each entry has "stations" (list or dict) and either "start" (unix time)
+    or "delay" (seconds from now). "clear": true drops pending entries first.
+    Starts more than QUEUE_MAX_AHEAD seconds ahead are rejected.
+    """
+    now = time.time()
+    entries = []
+    try:
+        for entry in cmd[u"batch"]:
+            if type(entry) is not dict:
+                raise TypeError(entry)
+            if u"start" in entry:
+                start = float(entry[u"start"])
+            else:
+                delay = float(entry.get(u"delay", 0))
+                if delay < 0:
+                    raise ValueError(entry[u"delay"])
+                start = now + delay
+            if not math.isfinite(start) or start > now + QUEUE_MAX_AHEAD:
+                raise ValueError(u"start out of range: {}".format(start))
+            rovals = station_values(entry[u"stations"], num_sta, strict=True)
+            if rovals is None or not all(
+                type(v) in (int, float) and math.isfinite(v) and v >= 0 for v in rovals
+            ):
+                raise ValueError(entry[u"stations"])
+            entries.append((start, rovals))
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        print(u"MQTT schedule rejected batch, invalid entry:", e)
+        return
+    with _queue_cv:
+        if cmd.get(u"clear"):
+            del _queue[:]
+        for start, rovals in entries:
+            heapq.heappush(_queue, (start, next(_queue_order), rovals))
+        _queue_cv.notify()
+    print(u"MQTT schedule queued {} run once".format(len(entries)))
+
+
+def queue_worker():
+    """Start queued run once programs when they are due."""
+    while True:
+        try:
+            with _queue_cv:
+                while not _queue or _queue[0][0] > time.time():
+                    _queue_cv.wait(_queue[0][0] - time.time() if _queue else None)
+                start, order, rovals = heapq.heappop(_queue)
+            if gv.sd[u"en"]:  # check operation status
+                run_once(rovals)
+        except Exception as e:
+            # Keep the worker running for the other queued run once
+            print(u"MQTT schedule queued run once failed:", e)
+
+
+def on_message(client, msg):
+    """Callback when MQTT message is received."""
+    if not gv.sd[u"en"]:  # check operation status
+        return
+    num_sta = gv.sd[u"nbrd"] * 8
+    try:
+        cmd = json.loads(msg.payload)
+    except ValueError as e:
+        print(u"MQTT Schedule could not decode command: ", msg.payload, e)
+        return
+    if type(cmd) is dict and u"batch" in cmd:
+        queue_batch(cmd, num_sta)
+        return
+    rovals = station_values(cmd, num_sta)
+    if rovals is None:
+        print(u"MQTT schedule unexpected command: ", msg.payload)
+        return
+    run_once(rovals)
+
+
 def subscribe():
     """
     Subscribe to messages
@@ -128,4 +221,10 @@ def subscribe():
         mqtt.subscribe(topic, on_message, 2)
 
 
+update_station_index()
+station_names = signal(u"station_names")
+station_names.connect(update_station_index)
+
+threading.Thread(target=queue_worker, daemon=True).start()
+
 subscribe()
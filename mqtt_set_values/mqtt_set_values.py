@@ -34,6 +34,17 @@ urls.extend(
 # fmt: on
 gv.plugin_menu.append([u"MQTT Set Values Plugin", u"/mqtt_set_values-sp"])
 
+# Supported values and their type, in the order they are applied
+VALUE_TYPES = [
+    (u"rd", float),  # Rain Delay
+    (u"wl", float),  # Water level
+    (u"mm", int),  # Manual mode
+    (u"en", int),  # Enable
+    (u"rsn", int),  # Reset (stop) all stations
+]
+
+_ack_topic = u""
+
 
 class settings(ProtectedPage):
     """
@@ -43,7 +54,8 @@ class settings(ProtectedPage):
     def GET(self):
         settings = mqtt.get_settings()
         set_values_topic = settings.get(u"set_values_topic", gv.sd[u"name"] + u"/set_values")
-        return template_render.mqtt_set_values(set_values_topic, "")  # open settings page
+        ack_topic = settings.get(u"set_values_ack_topic", u"")
+        return template_render.mqtt_set_values(set_values_topic, ack_topic, "")  # open settings page
 
 
 class save_settings(ProtectedPage):
@@ -65,44 +77,56 @@ class save_settings(ProtectedPage):
 
 
 def on_message(client, msg):
-    """Callback when MQTT message is received."""
+    """Callback when MQTT message is received.
+    All values are validated before any is applied, then a single
+    value_change is reported and applied values are echoed on the ack topic.
+    """
     try:
         values = json.loads(msg.payload)
-    except ValueError as e:
+        changes = {
+            key: value_type(values[key])
+            for key, value_type in VALUE_TYPES
+            if key in values
+        }
+    except (ValueError, TypeError) as e:
         print(u"MQTT Values could not decode command: ", msg.payload, e)
         return
+    if not changes:
+        return
+
     # Rain Delay
-    if 'rd' in values:
-        gv.sd['rd'] = float(values['rd'])
+    if 'rd' in changes:
+        gv.sd['rd'] = changes['rd']
         gv.sd['rdst'] = gv.now + gv.sd['rd'] * 3600 + 1  # +1 adds a smidge just so after a round trip the display hasn't already counted down by a minute.
         if float(gv.sd['rd']) > .0:
             stop_onrain()
-        report_value_change()
     # Water level
-    if 'wl' in values:
-        gv.sd['wl'] = float(values['wl'])
-        report_value_change()
+    if 'wl' in changes:
+        gv.sd['wl'] = changes['wl']
     # Manual mode
-    if 'mm' in values:
-        gv.sd['mm'] = int(values['mm'])
-        report_value_change()
+    if 'mm' in changes:
+        gv.sd['mm'] = changes['mm']
     # Enable
-    if 'en' in values:
-        gv.sd['en'] = int(values['en'])
-        report_value_change()
+    if 'en' in changes:
+        gv.sd['en'] = changes['en']
     # Reset (stop) all stations
-    if 'rsn' in values:
-        gv.sd['rsn'] = int(values['rsn'])
+    if 'rsn' in changes:
+        gv.sd['rsn'] = changes['rsn']
         stop_stations()
-        report_value_change()
-    return
+    report_value_change()
+
+    if _ack_topic:
+        client.publish(_ack_topic, json.dumps(changes), qos=1)
 
 
 def subscribe():
     """
     Subscribe to messages
     """
-    topic = mqtt.get_settings().get(u"set_values_topic")
+    global _ack_topic
+    settings = mqtt.get_settings()
+    _ack_topic = settings.get(u"set_values_ack_topic", u"")
+    topic = settings.get(u"set_values_topic")
     if topic:
         mqtt.subscribe(topic, on_message, 2)
 
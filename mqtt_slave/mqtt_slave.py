@@ -11,7 +11,6 @@ from six.moves import range
 
 # standard library imports
 import json  # for working with data file
-from time import sleep
 
 # local module imports
 import gv  # Get access to SIP's settings
@@ -34,6 +33,10 @@ urls.extend(
 # fmt: on
 gv.plugin_menu.append([u"MQTT slave", u"/mr2-sp"])
 
+_stations = []  # Master station index of each local station
+_ack_topic = u""
+_topics = []  # Subscribed control topics
+
 
 class settings(ProtectedPage):
     """Load an html page for entering plugin settings.
@@ -62,44 +65,103 @@ class save_settings(ProtectedPage):
         raise web.seeother(u"/")  # Return user to home page.
 
 
+def parse_slices(text):
+    """Return master station indexes from slices such as "1-8, 17-20, 25"."""
+    stations = []
+    for part in text.replace(u" ", u"").split(u","):
+        if not part:
+            continue
+        first, _, last = part.partition(u"-")
+        first = int(first)
+        last = int(last) if last else first
+        if first < 1 or last < first:
+            raise ValueError(part)
+        stations.extend(range(first - 1, last))
+    return stations
+
+
+def load_settings():
+    "Read slave settings once instead of on every message"
+    global _stations, _ack_topic
+    settings = mqtt.get_settings()
+    try:
+        _stations = parse_slices(settings.get(u"station_slices", u""))
+    except ValueError as e:
+        print(u"MQTT Slave invalid station slices: ", e)
+        _stations = []
+    if not _stations:
+        try:
+            first = int(settings.get(u"first_station")) - 1
+            count = int(settings.get(u"station_count"))
+            _stations = list(range(first, first + count))
+        except (TypeError, ValueError):
+            _stations = []
+    _ack_topic = settings.get(u"ack_topic", u"")
+    return settings
+
+
 def on_message(client, msg):
-    "Callback when MQTT message is received."
+    """Callback when MQTT message is received.
+    Accepts a zone_mask hex bitmask (bit 0 is master station 1), a zone_changes
+    delta or a zone_list from the master and applies it in a single pass.
+    """
     if not gv.sd[u"en"]:  # check operation status
         return
 
-    num_brds = gv.sd[u"nbrd"]
-    num_sta = num_brds * 8
     try:
         cmd = json.loads(msg.payload)
-    except ValueError as e:
+        if u"zone_mask" in cmd:
+            mask = int(cmd[u"zone_mask"], 16)
+            master_state = lambda i: (mask >> i) & 1
+        elif u"zone_changes" in cmd:
+            changes = {int(k): v for k, v in cmd[u"zone_changes"].items()}
+            master_state = changes.get
+        else:
+            zones = cmd[u"zone_list"]  #  list of all zones sent from master
+            master_state = lambda i: zones[i] if i < len(zones) else None
+    except (ValueError, TypeError, KeyError, AttributeError) as e:
         print(u"MQTT Slave could not decode command: ", msg.payload, e)
         return
 
-    zones = cmd["zone_list"]  #  list of all zones sent from master
-    first = int(mqtt.get_settings().get(u"first_station")) - 1
-    count = int(mqtt.get_settings().get(u"station_count"))
-    local_zones = zones[first : first + count]
-    for i in range(len(local_zones)):
-        if (
-            local_zones[i]  # if this element has a value and is not on
-            and not gv.srvals[i]
-        ):
+    applied = 0
+    for i, station in enumerate(_stations[: len(gv.srvals)]):
+        on = master_state(station)
+        if on is None:  # not part of a delta
+            on = gv.srvals[i]
+        elif on and not gv.srvals[i]:
             gv.rs[i][0] = gv.now
             gv.rs[i][1] = float("inf")
             gv.rs[i][3] = 99
             gv.ps[i][0] = 99
-        elif gv.srvals[i] and not local_zones[i]:
+        elif gv.srvals[i] and not on:
             gv.rs[i][1] = gv.now
+        if on:
+            applied |= 1 << station
     if any(gv.rs):
         gv.sd[u"bsy"] = 1
-    sleep(1)
+
+    if _ack_topic:
+        ack = {
+            u"name": gv.sd[u"name"],
+            u"seq": cmd.get(u"seq"),
+            u"stations": [i + 1 for i in _stations],
+            u"zone_mask": format(applied, u"x"),
+        }
+        client.publish(_ack_topic, json.dumps(ack), qos=1)
 
 
 def subscribe():
     "Subscribe to messages"
-    topic = mqtt.get_settings().get(u"control_topic")
-    if topic:
-        mqtt.subscribe(topic, on_message, 2)
+    global _topics
+    topic = load_settings().get(u"control_topic")
+    topics = [topic, topic + u"/delta"] if topic else []
+    if topics == _topics:
+        return
+    for t in _topics:
+        mqtt.unsubscribe(t, on_message)
+    _topics = topics
+    for t in topics:
+        mqtt.subscribe(t, on_message, 2)
 
 
 subscribe()
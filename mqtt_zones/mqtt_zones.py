@@ -11,6 +11,8 @@ from six.moves import zip
 
 # standard library imports
 import json  # for working with data file
+import threading
+import time
 
 # local module imports
 from blinker import signal  # To receive station notifications
@@ -32,6 +34,15 @@ urls.extend(
 # fmt: on
 gv.plugin_menu.append([u"MQTT zone broadcaster", u"/zone2mqtt-sp"])
 
+SNAPSHOT_INTERVAL_DEFAULT = 300  # seconds between full snapshots in delta mode
+
+_lock = threading.Lock()
+_seq = 0  # Sequence number of the last published payload
+_last_vals = []  # Zone states at last publish
+_delta_pending = False  # Deltas published since the last snapshot
+_last_snapshot = 0
+_request_topic = None
+
 
 class settings(ProtectedPage):
     """
@@ -41,7 +52,7 @@ class settings(ProtectedPage):
     def GET(self):
         settings = mqtt.get_settings()
         zone_topic = settings.get(u"zone_topic", gv.sd[u"name"] + u"/zones")
-        return template_render.mqtt_zones(zone_topic, "")  # open settings page
+        return template_render.mqtt_zones(zone_topic, settings, "")  # open settings page
 
 
 class save_settings(ProtectedPage):
@@ -57,27 +68,126 @@ class save_settings(ProtectedPage):
         )  # Dictionary of values returned as query string from settings page.
         settings = mqtt.get_settings()
         settings.update(qdict)
+        settings[u"zone_delta"] = u"on" if u"zone_delta" in qdict else u""
+        try:
+            settings[u"zone_snapshot_interval"] = max(
+                1, int(qdict.get(u"zone_snapshot_interval", SNAPSHOT_INTERVAL_DEFAULT))
+            )
+        except ValueError:
+            settings[u"zone_snapshot_interval"] = SNAPSHOT_INTERVAL_DEFAULT
         with open(mqtt.DATA_FILE, u"w") as f:
             json.dump(settings, f, indent=4, sort_keys=True)  # save to file
+        subscribe()
         raise web.seeother(u"/")  # Return user to home page.
 
 
-### valves ###
-def notify_zone_change(name, **kw):
+def publish(topic, payload, retain):
+    client = mqtt.get_client()
+    if client:
+        client.publish(topic, json.dumps(payload), qos=1, retain=retain)
+
+
+def publish_snapshot(zone_topic):
+    """Publish all zones states with a new sequence number"""
+    global _seq, _last_vals, _delta_pending, _last_snapshot
+    names = gv.snames
+    mas = gv.sd[u"mas"]
+    vals = list(gv.srvals)
+    with _lock:
+        _seq += 1
+        payload = {
+            u"seq": _seq,
+            u"zone_list": vals,
+            u"zone_dict": {name: status for name, status in zip(names, vals)},
+            u"master_on": 0 if mas == 0 else vals[mas - 1],
+            u"zone_mask": format(
+                sum(1 << i for i, status in enumerate(vals) if status), u"x"
+            ),
+        }
+        _last_vals = vals
+        _delta_pending = False
+        _last_snapshot = time.time()
+        publish(zone_topic, payload, retain=True)
+
+
+def publish_delta(zone_topic):
+    """Publish changed zones only with a new sequence number"""
+    global _seq, _last_vals, _delta_pending
     names = gv.snames
     mas = gv.sd[u"mas"]
-    vals = gv.srvals
-    payload = {
-        u"zone_list": vals,
-        u"zone_dict": {name: status for name, status in zip(names, vals)},
-        u"master_on": 0 if mas == 0 else vals[mas - 1],
-    }  
+    vals = list(gv.srvals)
+    with _lock:
+        changed = [
+            i
+            for i, status in enumerate(vals)
+            if i >= len(_last_vals) or _last_vals[i] != status
+        ]
+        if not changed:
+            return
+        _seq += 1
+        payload = {
+            u"seq": _seq,
+            u"zone_changes": {str(i): vals[i] for i in changed},
+            u"zone_dict": {names[i]: vals[i] for i in changed if i < len(names)},
+            u"master_on": 0 if mas == 0 else vals[mas - 1],
+        }
+        _last_vals = vals
+        _delta_pending = True
+        publish(zone_topic + u"/delta", payload, retain=False)
+
+
+### valves ###
+def notify_zone_change(name, **kw):
+    settings = mqtt.get_settings()
+    zone_topic = settings.get(u"zone_topic")
+    if not zone_topic:
+        return
+    interval = int(settings.get(u"zone_snapshot_interval", SNAPSHOT_INTERVAL_DEFAULT))
+    if not settings.get(u"zone_delta") or time.time() - _last_snapshot >= interval:
+        publish_snapshot(zone_topic)
+    else:
+        publish_delta(zone_topic)
+
+
+def on_snapshot_request(client, msg):
+    """Callback when a full snapshot is requested over MQTT."""
     zone_topic = mqtt.get_settings().get(u"zone_topic")
     if zone_topic:
-        client = mqtt.get_client()
-        if client:
-            client.publish(zone_topic, json.dumps(payload), qos=1, retain=True)
+        publish_snapshot(zone_topic)
+
+
+def snapshot_loop():
+    """Refresh the retained snapshot when deltas were published since the last one"""
+    while True:
+        settings = mqtt.get_settings()
+        interval = int(settings.get(u"zone_snapshot_interval", SNAPSHOT_INTERVAL_DEFAULT))
+        zone_topic = settings.get(u"zone_topic")
+        if (
+            zone_topic
+            and settings.get(u"zone_delta")
+            and _delta_pending
+            and time.time() - _last_snapshot >= interval
+        ):
+            publish_snapshot(zone_topic)
+        time.sleep(min(interval, 60))
+
+
+def subscribe():
+    """Subscribe to snapshot requests on <zone topic>/get"""
+    global _request_topic
+    zone_topic = mqtt.get_settings().get(u"zone_topic")
+    topic = zone_topic + u"/get" if zone_topic else None
+    if topic == _request_topic:
+        return
+    if _request_topic:
+        mqtt.unsubscribe(_request_topic, on_snapshot_request)
+    _request_topic = topic
+    if topic:
+        mqtt.subscribe(topic, on_snapshot_request)
 
 
 zones = signal(u"zone_change")
 zones.connect(notify_zone_change)
+
+subscribe()
+threading.Thread(target=snapshot_loop, daemon=True).start()
@@ -4,7 +4,11 @@
 # Node-RED SIP extension plugin
 
 # standard library imports
+import asyncio
+import hashlib
 import json  # for working with data file
+import queue
+import threading
 from time import sleep
 
 # local module imports
@@ -21,6 +25,11 @@ from webpages import ProtectedPage  # Needed for security
 from webpages import report_option_change, report_value_change
 from webpages import change_options
 
+try:
+    import websockets  # Optional, for the WebSocket channel
+except ImportError:
+    websockets = None
+
 
 # Add new URLs to access classes in this plugin.
 # fmt: off
@@ -41,6 +50,28 @@ prior_srvals = [0] * len(gv.srvals)
 # prior_progs = sorted(gv.pd)
 nr_settings = {}
 
+out_queue_size = 100  # messages waiting for node-red, oldest dropped when full
+out_timeout = (3, 10)  # connect and read timeouts in seconds
+out_retries = 3
+out_backoff = 1  # seconds before first retry, doubled after each failure
+out_queue = queue.Queue(maxsize=out_queue_size)
+out_session = requests.Session()  # keep-alive connection to node-red
+
+zone_batch_window = 0.25  # seconds to coalesce station changes in one message
+zone_batch = {}  # station number -> change waiting to be sent
+zone_batch_lock = threading.Lock()
+zone_batch_timer = None
+
+ws_host_default = "127.0.0.1"  # only local clients unless set otherwise
+ws_port_default = 8765
+ws_timeout = 5  # seconds to wait for the server to start or stop
+ws_loop = None  # asyncio loop of the WebSocket server thread
+ws_server = None  # running WebSocket server
+ws_address = None  # (host, port) the server is bound to
+ws_lock = threading.Lock()
+ws_clients = set()  # connected node-red WebSocket clients
+ws_clients_lock = threading.Lock()  # clients change on the server loop
+
 list_vars = [
     "ps",
     "rovals",
@@ -65,14 +96,24 @@ not_writable = [
     "output_srvals",
     "output_srvals_lock",
     "passphrase",
+    "password",
     "plugin_data",
     "plugin_menu",
     "pw",
+    "salt",
     "upas",
     "ver_str",
     "ver_date",
     ]
 
+not_readable = [  # never sent to node-red
+    "npw",
+    "passphrase",
+    "password",
+    "pw",
+    "salt",
+    ]
+
 danger_list = [
     "nst",
     "nopts",
@@ -259,6 +300,28 @@ def bit_read(byts, read_lst):
     return res_dict
 
 
+def select_numbers(values, numbers):
+    """Return dict of list elements per 1 based number (station or item)."""
+    sel_lst = []
+    try:
+        for i in numbers:
+            sel_lst.append(values[i - 1])
+    except IndexError:
+        pass
+    return dict(zip(numbers, sel_lst))
+
+
+def select_index(values, indexes):
+    """Return dict of list elements per 0 based index."""
+    sel_lst = []
+    try:
+        for i in indexes:
+            sel_lst.append(values[i])
+    except IndexError:
+        pass
+    return dict(zip(indexes, sel_lst))
+
+
 def bit_write(bytes, bit_dict):
     """Turn bits on or off."""
     for key, value in bit_dict.items():
@@ -299,13 +362,171 @@ def load_settings():
 load_settings()
 
 
-def to_node_red(msg):
-    url = nr_settings["nr-url"]
+def to_node_red(msg, as_json=False):
+    """Queue a message for node-red without blocking the caller.
+    The oldest waiting message is dropped if the queue is full.
+    as_json sends the message as a JSON body instead of form data.
+    Messages go over the WebSocket channel instead when a client is connected.
+    """
+    if "ws-channel" in nr_settings and ws_clients:
+        ws_send(msg)
+        return
+    while True:
+        try:
+            out_queue.put_nowait((msg, as_json))
+            return
+        except queue.Full:
+            try:
+                out_queue.get_nowait()
+                print("Node-red queue full, oldest message dropped")
+            except queue.Empty:
+                pass
+
+
+def node_red_sender():
+    """Post queued messages to node-red, retrying with back-off."""
+    while True:
+        msg, as_json = out_queue.get()
+        delay = out_backoff
+        for attempt in range(out_retries + 1):
+            try:
+                if as_json:
+                    resp = out_session.post(nr_settings["nr-url"], json=msg, timeout=out_timeout)
+                else:
+                    resp = out_session.post(nr_settings["nr-url"], data=msg, timeout=out_timeout)
+                # Server errors are retried like connection errors
+                resp.raise_for_status()
+                break
+            except Exception as e:
+                if attempt == out_retries:
+                    print("Node-red message dropped: ", e)
+                else:
+                    sleep(delay)
+                    delay *= 2
+
+
+threading.Thread(target=node_red_sender, daemon=True).start()
+
+
+def ws_send(msg):
+    """Send a message as JSON to all WebSocket clients."""
+    with ws_lock:
+        loop = ws_loop
+    with ws_clients_lock:
+        clients = list(ws_clients)
+    if loop is None:
+        return
+    payload = json.dumps(msg)
+    for ws in clients:
+        send = ws.send(payload)
+        try:
+            asyncio.run_coroutine_threadsafe(send, loop)
+        except RuntimeError:  # server stopped meanwhile
+            send.close()
+            return
+
+
+async def ws_handler(websocket, path=None):
+    """Handle a node-red WebSocket connection.
+    Messages use the same JSON as POST requests to /jsin,
+    {"read": [...]} uses the same queries as a bulk GET.
+    """
+    loop = asyncio.get_running_loop()
+    with ws_clients_lock:
+        ws_clients.add(websocket)
     try:
-        resp = requests.post(url, data = msg)
-    except Exception:
-        pass
-        
+        async for message in websocket:
+            try:
+                data = json.loads(message)
+                if "read" in data:
+                    result = [read_value(query) for query in data["read"]]
+                else:
+                    # Commands block on SIP, files and HTTP, keep the loop serving
+                    result = await loop.run_in_executor(None, handle_requests.command, data)
+            except Exception as e:
+                result = {"error": str(e)}
+            if result is not None:
+                await websocket.send(json.dumps({"reply": result}, default=str))
+    except Exception as e:
+        print("Node-red WebSocket closed: ", e)
+    finally:
+        with ws_clients_lock:
+            ws_clients.discard(websocket)
+
+
+async def ws_listen(host, port):
+    """Start listening for WebSocket connections."""
+    return await websockets.serve(ws_handler, host, port)
+
+
+async def ws_close(server):
+    """Stop listening and close the WebSocket connections."""
+    server.close()
+    await server.wait_closed()
+
+
+def ws_run(loop):
+    """Run the asyncio loop of the WebSocket server until stopped."""
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+    loop.close()
+
+
+def ws_settings_address():
+    """Return the (host, port) set for the WebSocket server, None if disabled."""
+    if "ws-channel" not in nr_settings:
+        return None
+    host = nr_settings.get("ws-host") or ws_host_default
+    try:
+        port = int(nr_settings.get("ws-port", ws_port_default))
+    except ValueError:
+        port = ws_port_default
+    return (host, port)
+
+
+def ws_stop():
+    """Stop the WebSocket server. Call with ws_lock held."""
+    global ws_loop, ws_server, ws_address
+    try:
+        asyncio.run_coroutine_threadsafe(ws_close(ws_server), ws_loop).result(ws_timeout)
+    except Exception as e:
+        print("Node-red WebSocket server did not close cleanly: ", e)
+    ws_loop.call_soon_threadsafe(ws_loop.stop)
+    with ws_clients_lock:
+        ws_clients.clear()
+    ws_loop = ws_server = ws_address = None
+
+
+def ws_start():
+    """Start, rebind or stop the WebSocket server to match the settings."""
+    global ws_loop, ws_server, ws_address
+    with ws_lock:
+        address = ws_settings_address()
+        if address == ws_address:
+            return
+        if ws_loop is not None:
+            ws_stop()
+            print("Node-red WebSocket server stopped")
+        if address is None:
+            return
+        if websockets is None:
+            print("Node-red WebSocket channel requires the websockets package.")
+            print("\ttry: pip3 install websockets")
+            return
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=ws_run, args=(loop,), daemon=True).start()
+        try:
+            server = asyncio.run_coroutine_threadsafe(
+                ws_listen(*address), loop
+            ).result(ws_timeout)
+        except Exception as e:
+            print("Node-red WebSocket server failed to start: ", e)
+            loop.call_soon_threadsafe(loop.stop)
+            return
+        ws_loop, ws_server, ws_address = loop, server, address
+        print("Node-red WebSocket server listening on ", address)
+
+
 
 # def nr_run_once(list, pre):
 #     """-
@@ -453,6 +674,35 @@ def run_now(ident):
 
 ### send blinker signals ###
 
+def send_zone_batch():
+    """Send all station changes collected during the batch window in one message."""
+    global zone_batch, zone_batch_timer
+    with zone_batch_lock:
+        changes = [zone_batch[k] for k in sorted(zone_batch)]
+        zone_batch = {}
+        zone_batch_timer = None
+    if changes:
+        to_node_red({"stations": changes}, as_json=True)
+
+
+def batch_zone_change():
+    """Collect changed stations, the first change starts the batch window."""
+    global prior_srvals, zone_batch_timer
+    with zone_batch_lock:
+        for i in range(len(gv.srvals)):
+            if gv.srvals[i] != prior_srvals[i]:
+                if gv.sd["mas"] and gv.sd["mas"] == i + 1:
+                    name = "master"
+                else:
+                    name = gv.snames[i]
+                zone_batch[i + 1] = {"station": i + 1, "name": name, "state": gv.srvals[i]}
+        prior_srvals = gv.srvals[:]
+        if zone_batch and not zone_batch_timer:
+            zone_batch_timer = threading.Timer(zone_batch_window, send_zone_batch)
+            zone_batch_timer.daemon = True
+            zone_batch_timer.start()
+
+
 def send_zone_change(name, **kw):
     """Send notification to node-red
     when core program signals a change in station state.
@@ -463,6 +713,10 @@ def send_zone_change(name, **kw):
     if not "station-on-off" in nr_settings:
         # to_node_red("Station status is disabled")  # - test
         return
+    if "batch-stn" in nr_settings:
+        if gv.srvals != prior_srvals:
+            batch_zone_change()
+        return
     if gv.srvals != prior_srvals:  # check for a change
         for i in range(len(gv.srvals)):
             if (
@@ -545,6 +799,55 @@ loggedin.connect(send_login)
 
 #### function dicts ####
 
+def read_gv(query):
+    attr = str(query["gv"])
+    if attr in not_readable:
+        raise KeyError("gv." + attr + " is not readable")
+    return getattr(gv, attr)
+
+
+def read_sd(query):
+    key = query["sd"]
+    if key in not_readable:
+        raise KeyError("sd " + str(key) + " is not readable")
+    return gv.sd[key]
+
+
+read_sources = {
+    "gv": read_gv,
+    "sd": read_sd,
+    }
+
+read_selectors = {  # checked in this order
+    "sn": select_numbers,
+    "station": select_numbers,
+    "item": select_numbers,
+    "index": select_index,
+    "bit": bit_read,
+    }
+
+
+def read_value(query):
+    """Resolve a read query such as {"gv": "srvals", "sn": [1, 2]}.
+    Selector values may be JSON strings (query string) or lists (bulk).
+    """
+    for source, read in read_sources.items():
+        if source in query:
+            values = read(query)
+            break
+    else:
+        raise KeyError("Unknown request")
+    if isinstance(values, dict):  # such as gv.sd
+        values = {k: v for k, v in values.items() if k not in not_readable}
+    for key, select in read_selectors.items():
+        if key in query:
+            sel = query[key]
+            if isinstance(sel, str):
+                sel = json.loads(sel)
+            return select(values, sel)
+    return values
+
+
 get_gv = {
     
     }
@@ -608,6 +911,7 @@ class save_settings(ProtectedPage):
         with open("./data/node_red.json", "w") as f:
             json.dump(qdict, f, indent=4)  # save to file
             nr_settings = dict(qdict)
+        ws_start()
         raise web.seeother("/")  # Return user to home page.
 
 
@@ -618,74 +922,49 @@ class handle_requests(object):
     def GET(self):
         """return a value from get request."""
         qdict = dict(web.input())  # Dictionary of JSON values
-        if "gv" in qdict:
-            attr = str(qdict["gv"])
-            try:
-                if attr in list_vars:
-                    gv_lst = getattr(gv, attr)
-                    sel_lst = [] # empty list to hold elements from list in qdict
-
-                if "sn" in qdict or "station" in qdict:
-                    sn_lst = []
-                    if "sn" in qdict:
-                        sn_lst = json.loads(qdict["sn"])
-                    elif "station" in qdict:
-                        sn_lst = json.loads(qdict["station"])
-                    for i in sn_lst:
-                        sel_lst.append(gv_lst[i - 1])
-                    res_dict = dict(zip(sn_lst, sel_lst))
-                    return res_dict
-                
-                elif "item" in qdict:
-                    item_lst = json.loads(qdict["item"])
-                    try:
-                        for i in item_lst:
-                            sel_lst.append(gv_lst[i - 1])
-                    except TypeError:
-                        return "Error, item value must be an array in double quotes"
-                    except IndexError:
-                        pass
-                    res_dict = dict(zip(item_lst, sel_lst))
-                    return res_dict
-                
-                elif "index" in qdict:
-                    index_lst = json.loads(qdict["index"])
-                    try:
-                        for i in index_lst:
-                            sel_lst.append(gv_lst[i])
-                    except TypeError:
-                        return "Error, item value must be an array in double quotes"
-                    except IndexError:
-                        pass
-                    res_dict = dict(zip(index_lst, sel_lst))
-                    return res_dict
-                
-                elif "bit" in qdict:
-                    bit_dict = bit_read(getattr(gv, attr), json.loads(qdict["bit"]))
-                    return json.dumps(bit_dict)
-                
-                else:
-                    return json.dumps(getattr(gv, attr))
-                
-            except Exception as e:
-                return e
-            
-        elif "sd" in qdict:
+        if "bulk" in qdict:
+            return self.bulk(qdict["bulk"])
+        if not ("gv" in qdict or "sd" in qdict):
+            return "Unknown request"
+        try:
+            value = read_value(qdict)
+        except Exception as e:
+            return e
+        if "gv" in qdict and any(k in qdict for k in ("sn", "station", "item", "index")):
+            return value
+        return json.dumps(value)
+
+    def bulk(self, queries):
+        """Return results of a JSON list of read queries as a JSON list.
+        Supports If-None-Match with an ETag of the response.
+        """
+        try:
+            queries = json.loads(queries)
+        except ValueError as e:
+            return e
+        results = []
+        for query in queries:
             try:
-                if "bit" in qdict:
-                    bit_dict = bit_read(gv.sd[qdict["sd"]], json.loads(qdict["bit"]))
-                    return json.dumps(bit_dict)               
-                else:
-                    return json.dumps(gv.sd[qdict["sd"]])
+                results.append(read_value(query))
             except Exception as e:
-                return e
-        else:
-            return "Unknown request"
+                results.append({"error": str(e)})
+        body = json.dumps(results)
+        etag = '"' + hashlib.sha1(body.encode("utf-8")).hexdigest() + '"'
+        web.header("ETag", etag)
+        if web.ctx.env.get("HTTP_IF_NONE_MATCH") == etag:
+            raise web.notmodified()
+        web.header("Content-Type", "application/json")
+        return body
 
     def POST(self):
         """Update SIP with value sent from node-red."""
         data = web.data()
         data = json.loads(data.decode("utf-8"))
+        return self.command(data)
+
+    @staticmethod
+    def command(data):
+        """Update SIP with a command sent from node-red (HTTP POST or WebSocket)."""
 
         #######################
         #### Set gv values ####
@@ -839,3 +1118,6 @@ class handle_requests(object):
             msg = "Unknown request"
             to_node_red(msg)
             return
+
+
+ws_start()
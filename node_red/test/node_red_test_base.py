@@ -0,0 +1,23 @@
+import builtins
+import os
+import sys
+
+# Insert test directories and this plugin's directory
+TEST_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, TEST_DIR)
+STUB_DIR = os.path.join(TEST_DIR, "stubs")
+sys.path.insert(0, STUB_DIR)
+NODE_RED_DIR = os.path.realpath(os.path.join(TEST_DIR, '..'))
+sys.path.insert(0, NODE_RED_DIR)
+# Load stubbed-out components for node_red
+sys.modules['web'] = __import__('stub_web')
+sys.modules['gv'] = __import__('stub_gv')
+sys.modules['urls'] = __import__('stub_urls')
+sys.modules['sip'] = __import__('stub_sip')
+sys.modules['webpages'] = __import__('stub_webpages')
+sys.modules['blinker'] = __import__('stub_blinker')
+sys.modules['helpers'] = __import__('stub_helpers')
+sys.modules['gpio_pins'] = __import__('stub_gpio_pins')
+sys.modules['requests'] = __import__('stub_requests')
+# SIP installs the gettext function
+builtins._ = lambda s: s
@@ -0,0 +1 @@
+# node_red only uses gpio_pins when switching stations
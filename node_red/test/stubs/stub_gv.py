@@ -0,0 +1,7 @@
+plugin_menu = []
+now = 0
+sd = {u"nst": 8, u"rd": 0, u"wl": 100, u"password": u"hash", u"salt": u"salt"}
+srvals = [0] * 8
+snames = [u"S01", u"S02", u"S03", u"S04", u"S05", u"S06", u"S07", u"S08"]
+rovals = [0] * 8
+pw = u"secret"
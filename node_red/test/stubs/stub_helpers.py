@@ -0,0 +1,8 @@
+def jsave(*args, **kwargs):
+    pass
+
+def run_once(*args, **kwargs):
+    pass
+
+def stop_stations(*args, **kwargs):
+    pass
@@ -0,0 +1,12 @@
+class Response:
+    def __init__(self, status_code=200):
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception(str(self.status_code) + " Server Error")
+
+
+class Session:
+    def post(self, *args, **kwargs):
+        return Response()
@@ -0,0 +1,5 @@
+def input(*args, **kwargs):
+    pass
+
+def seeother(*args, **kwargs):
+    pass
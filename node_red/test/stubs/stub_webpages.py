@@ -0,0 +1,11 @@
+class ProtectedPage:
+    pass
+
+def report_option_change(*args, **kwargs):
+    pass
+
+def report_value_change(*args, **kwargs):
+    pass
+
+def change_options(*args, **kwargs):
+    pass
@@ -0,0 +1,46 @@
+import time
+import unittest
+from unittest.mock import patch
+# This will stub sip things out
+import node_red_test_base
+# Now that things have been stubbed out, node_red may be imported
+import node_red
+from stub_requests import Response
+
+
+def send_and_wait(responses, expected_posts):
+    """Queue one message and wait for the sender thread to post it"""
+    posts = []
+
+    def post(*args, **kwargs):
+        posts.append(kwargs)
+        return responses[min(len(posts), len(responses)) - 1]
+
+    with patch.object(node_red.out_session, "post", side_effect=post), \
+            patch("node_red.out_backoff", 0), \
+            patch.dict(node_red.nr_settings, {"nr-url": "http://localhost/node-red"}):
+        node_red.to_node_red({"msg": 1})
+        deadline = time.time() + 5
+        while len(posts) < expected_posts and time.time() < deadline:
+            time.sleep(0.01)
+        # Let the sender finish the message
+        time.sleep(0.1)
+    return posts
+
+
+class TestNodeRedSender(unittest.TestCase):
+    def test_delivered(self):
+        posts = send_and_wait([Response(200)], 1)
+        self.assertEqual(len(posts), 1)
+
+    def test_server_error_retried(self):
+        posts = send_and_wait([Response(500), Response(503), Response(200)], 3)
+        self.assertEqual(len(posts), 3)
+
+    def test_dropped_after_retries(self):
+        posts = send_and_wait([Response(404)], node_red.out_retries + 1)
+        self.assertEqual(len(posts), node_red.out_retries + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
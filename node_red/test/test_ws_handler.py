@@ -0,0 +1,134 @@
+import asyncio
+import json
+import threading
+import unittest
+from unittest.mock import patch
+# This will stub sip things out
+import node_red_test_base
+# Now that things have been stubbed out, node_red may be imported
+import node_red
+import gv
+
+
+class FakeWebSocket:
+    """Connection yielding the given messages and keeping the replies"""
+    def __init__(self, *messages):
+        self.messages = [json.dumps(m) if not isinstance(m, str) else m for m in messages]
+        self.replies = []
+
+    def __aiter__(self):
+        return self._messages()
+
+    async def _messages(self):
+        for message in self.messages:
+            # The handler registers the client before reading
+            assert self in node_red.ws_clients
+            yield message
+
+    async def send(self, payload):
+        self.replies.append(json.loads(payload))
+
+
+def run_handler(*messages):
+    websocket = FakeWebSocket(*messages)
+    asyncio.run(node_red.ws_handler(websocket))
+    return websocket
+
+
+class TestWsHandler(unittest.TestCase):
+    def setUp(self):
+        self.settings = patch.dict(node_red.nr_settings, {"stop-stn": "on"}, clear=True)
+        self.settings.start()
+
+    def tearDown(self):
+        self.settings.stop()
+
+    def test_read(self):
+        websocket = run_handler({"read": [{"gv": "srvals"}, {"sd": "wl"}, {"gv": "snames", "sn": [2]}]})
+        self.assertEqual(websocket.replies, [{"reply": [gv.srvals, 100, {"2": "S02"}]}])
+        self.assertNotIn(websocket, node_red.ws_clients)
+
+    def test_read_blocked(self):
+        for query in ({"gv": "pw"}, {"sd": "password"}, {"sd": "salt"}):
+            websocket = run_handler({"read": [query]})
+            self.assertIn("error", websocket.replies[0]["reply"])
+
+    def test_read_sd_dict_filtered(self):
+        websocket = run_handler({"read": [{"gv": "sd"}]})
+        sd = websocket.replies[0]["reply"][0]
+        self.assertEqual(sd["wl"], 100)
+        self.assertNotIn("password", sd)
+        self.assertNotIn("salt", sd)
+
+    def test_command(self):
+        with patch("node_red.stop_stations") as stop_stations:
+            websocket = run_handler({"stopAll": 1})
+        stop_stations.assert_called_once_with()
+        # Commands without a result are not answered
+        self.assertEqual(websocket.replies, [])
+
+    def test_command_in_executor(self):
+        threads = []
+        with patch("node_red.stop_stations", side_effect=lambda: threads.append(threading.current_thread())):
+            run_handler({"stopAll": 1})
+        self.assertIsNot(threads[0], threading.main_thread())
+
+    def test_command_reply(self):
+        node_red.nr_settings["chng-gv"] = "on"
+        websocket = run_handler({"gv": "pw", "val": "x"})
+        self.assertEqual(websocket.replies, [{"reply": "gv.pw is not writable"}])
+        self.assertEqual(gv.pw, "secret")
+
+    def test_invalid_message(self):
+        websocket = run_handler("not json", {"read": [{"gv": "srvals"}]})
+        self.assertIn("error", websocket.replies[0]["reply"])
+        # The connection keeps being served
+        self.assertEqual(websocket.replies[1], {"reply": [gv.srvals]})
+
+
+class TestWsSend(unittest.TestCase):
+    def test_server_stopped(self):
+        websocket = FakeWebSocket()
+        with patch("node_red.ws_loop", None), patch("node_red.ws_clients", {websocket}):
+            node_red.ws_send({"msg": 1})
+        self.assertEqual(websocket.replies, [])
+
+
+class TestWsSettingsAddress(unittest.TestCase):
+    def test_disabled(self):
+        with patch.dict(node_red.nr_settings, {}, clear=True):
+            self.assertIsNone(node_red.ws_settings_address())
+
+    def test_default_local(self):
+        with patch.dict(node_red.nr_settings, {"ws-channel": "on", "ws-port": "bad"}, clear=True):
+            self.assertEqual(node_red.ws_settings_address(), ("127.0.0.1", 8765))
+
+    def test_host_port(self):
+        settings = {"ws-channel": "on", "ws-host": "0.0.0.0", "ws-port": "9000"}
+        with patch.dict(node_red.nr_settings, settings, clear=True):
+            self.assertEqual(node_red.ws_settings_address(), ("0.0.0.0", 9000))
+
+
+@unittest.skipIf(node_red.websockets is None, "websockets package not installed")
+class TestWsStart(unittest.TestCase):
+    def tearDown(self):
+        with patch.dict(node_red.nr_settings, {}, clear=True):
+            node_red.ws_start()
+
+    def test_rebind_and_stop(self):
+        with patch.dict(node_red.nr_settings, {"ws-channel": "on", "ws-port": "0"}, clear=True):
+            node_red.ws_start()
+            first_loop = node_red.ws_loop
+            self.assertEqual(node_red.ws_address, ("127.0.0.1", 0))
+        with patch.dict(node_red.nr_settings, {"ws-channel": "on", "ws-port": "0", "ws-host": "localhost"}, clear=True):
+            node_red.ws_start()
+            self.assertEqual(node_red.ws_address, ("localhost", 0))
+            self.assertIsNot(node_red.ws_loop, first_loop)
+        with patch.dict(node_red.nr_settings, {}, clear=True):
+            node_red.ws_start()
+            self.assertIsNone(node_red.ws_loop)
+            self.assertIsNone(node_red.ws_server)
+
+
+if __name__ == '__main__':
+    unittest.main()
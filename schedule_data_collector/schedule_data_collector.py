@@ -13,8 +13,17 @@ import gv  # Get access to SIP's settings
 # import web  # web.py framework
 # from webpages import ProtectedPage  # Needed for security
 
+import atexit
+import calendar
 import datetime
 import os
+import sys
+import threading
+import time
+
+# Storage shared with Simple Chart, shipped with both plugins
+sys.path.insert(0, "./plugins/segmented_storage_helpers")
+import segmented_storage
 
 # Add this plugin to the PLUGINS menu ["Menu Name", "URL"], (Optional)
 # gv.plugin_menu.append([_("Schedule Data Collector"), "/schedule_data_collector"])
@@ -24,6 +33,17 @@ SCHEDULE_DATA_PATH = "./static/data/schedule_data_collector"
 CONFIG_FILE_PATH = "./data/schedule_data_collector.json"
 # 60 days, in seconds
 RETENTION = 86400 * 60
+# Seconds between checks for running stations, buffered statistics are
+# written as soon as no station is running
+FLUSH_IDLE_CHECK = 5
+# Seconds buffered statistics are held at most before being written to disk
+FLUSH_INTERVAL = 60
+
+# Buffered rows waiting to be written, series path -> list of (timestamp, value)
+pending_rows = {}
+pending_lock = threading.Lock()
+flush_timer = None
+pending_since = None  # time the oldest buffered row was logged
 
 
 def validate_int_list(int_list):
@@ -41,133 +61,231 @@ def validate_int_list(int_list):
     return tuple(validated_list)
 
 
-def create_station_data_file(new_file):
-    """Use x and y as headings for the graph plugin"""
-    with open(new_file, "w") as f:
-        f.write("x,y\n")
+def sip_day(timestamp):
+    """Return the day of a SIP timestamp in seconds. gv.now and the run
+    times are local wall time encoded as UTC, so they are decoded as UTC.
+    """
+    return datetime.datetime.utcfromtimestamp(timestamp).date()
+
+
+def day_milli(day):
+    """Return midnight of a day as a SIP timestamp in milliseconds"""
+    return calendar.timegm(day.timetuple()) * 1000
+
+
+def series_path(station, period, stat):
+    """Segmented series directory of a station statistic"""
+    return os.path.join(SCHEDULE_DATA_PATH, period, str(station) + "_" + stat)
 
 
 def log_stat(timestamp, value, station, period, stat):
-    """Log scheduling statistic. Required directories are created at
-    startup.
+    """Buffer a scheduling statistic. Rows are written by flush_stats()
+    once no station is running, so the runs of a program are written
+    together, after FLUSH_INTERVAL seconds at most, or at shutdown.
+    Required directories are created at startup.
     """
+    global pending_since
 
-    data_file_path = os.path.join(
-        SCHEDULE_DATA_PATH, period, str(station) + "_" + stat + ".csv"
-    )
+    with pending_lock:
+        # Log timestamp as milliseconds for chart.js
+        pending_rows.setdefault(series_path(station, period, stat), []).append(
+            (timestamp * 1000, value)
+        )
 
-    if not os.path.isfile(data_file_path):
-        create_station_data_file(data_file_path)
+        if pending_since is None:
+            pending_since = time.time()
+        if flush_timer is None:
+            start_flush_timer()
 
-    with open(data_file_path, "a") as f:
-        # Log timestamp as milliseconds for chart.js
-        f.write(f"{timestamp * 1000},{value}\n")
 
+def start_flush_timer():
+    """Check for idle stations after FLUSH_IDLE_CHECK seconds. Call with
+    pending_lock held.
+    """
+    global flush_timer
 
-def accumulate_data_files():
-    """Sum the discrete values for a day and save an accumulated
-    daily total.
+    flush_timer = threading.Timer(FLUSH_IDLE_CHECK, flush_when_idle)
+    flush_timer.daemon = True
+    flush_timer.start()
+
+
+def flush_when_idle():
+    """Write the buffered rows unless a station is still running"""
+    global flush_timer
+
+    with pending_lock:
+        flush_timer = None
+        if not pending_rows:
+            # Already written by flush_stats()
+            return
+        if any(gv.srvals) and time.time() - pending_since < FLUSH_INTERVAL:
+            start_flush_timer()
+            return
+
+    flush_stats()
+
+
+def flush_stats(*args, **kw):
+    """Append all buffered rows, opening each segment file once. Also
+    connected to the restarting signal so no rows are lost.
+    """
+    global pending_rows, flush_timer, pending_since
+
+    with pending_lock:
+        rows = pending_rows
+        pending_rows = {}
+        pending_since = None
+        if flush_timer is not None:
+            flush_timer.cancel()
+            flush_timer = None
+
+    for path, series_rows in rows.items():
+        segmented_storage.open_series(path).append(series_rows)
+
+
+def accumulate_segment(segment_file, offset, today, totals):
+    """Add the rows of a discrete segment after offset to the daily
+    totals. Returns the offset reached and False if a row from today
+    stopped the reading.
+    """
+    with open(segment_file, "rb") as f:
+        if offset == 0:
+            # Skip headers
+            f.readline()
+            offset = f.tell()
+        else:
+            f.seek(offset)
+
+        for line in iter(f.readline, b""):
+            if not line.endswith(b"\n"):
+                # Row still being written
+                return offset, False
+
+            try:
+                fields = line.decode().split(",")
+                day = sip_day(int(float(fields[0])) / 1000)
+                value = int(float(fields[1]))
+            except (ValueError, IndexError):
+                offset += len(line)
+                continue
+
+            if day >= today:
+                return offset, False
+
+            totals[day] = totals.get(day, 0) + value
+            offset += len(line)
+
+    return offset, True
+
+
+def accumulate_series(discrete_path, daily_path):
+    """Fold the discrete rows added since the last run into daily totals.
+
+    Reading starts at the offset saved for each segment, so only new
+    rows are read. Only complete days are folded, rows from today are
+    left for the next run. The offsets are saved with the merged totals so
+    rows are never counted twice.
+    """
+    offsets = dict(settings.setdefault("accumulate_offsets", {}))
+    today = sip_day(gv.now)
+    totals = {}
+
+    discrete = segmented_storage.open_series(discrete_path)
+    for start, end, segment_file in discrete.segment_files():
+        try:
+            size = os.path.getsize(segment_file)
+        except OSError:
+            continue
+
+        offset = offsets.get(segment_file, 0)
+        if offset > size:
+            # Segment was replaced, start again
+            offset = 0
+        if offset == size:
+            continue
+
+        offset, complete = accumulate_segment(segment_file, offset, today, totals)
+        offsets[segment_file] = offset
+        if not complete:
+            break
+
+    if totals:
+        merge_totals(daily_path, totals)
+
+    if offsets != settings["accumulate_offsets"]:
+        settings["accumulate_offsets"] = offsets
+        save_schedule_data_collector_settings()
+
+
+def merge_totals(daily_path, totals):
+    """Add the totals of each day to the daily series"""
+    # Late rows may belong to a day already in the daily totals
+    daily = segmented_storage.open_series(daily_path)
+    first_day = day_milli(min(totals))
+    existing = {}
+    for line in daily.read(first_day):
+        fields = line.split(",")
+        try:
+            existing[int(float(fields[0]))] = int(float(fields[1]))
+        except (ValueError, IndexError):
+            continue
 
-    As I do not know if this functionality is required I will leave it
-    for the next version of the plugin"""
+    rows = []
+    for day, total in sorted(totals.items()):
+        # Log timestamp of midnight as milliseconds for chart.js
+        day_ms = day_milli(day)
+        rows.append((day_ms, existing.get(day_ms, 0) + total))
+    daily.merge(rows)
 
-    return
 
-    now = datetime.datetime.now()
+def accumulate_data_files():
+    """Sum the discrete values for a day and save an accumulated
+    daily total. Runs on new_day, reading only the rows added since the
+    previous run.
+    """
+    flush_stats()
 
     # for station in settings["stations"].keys():
     for station in range(0, len(gv.snames)):
         for stat in ["planned", "actual", "diff"]:
-            discrete_data_file = os.path.join(
-                SCHEDULE_DATA_PATH, "discrete", station + "_" + stat + ".csv"
-            )
-            accumulated_data_file = os.path.join(
-                SCHEDULE_DATA_PATH, "daily", station + "_" + stat + ".csv"
-            )
-            if os.path.isfile(discrete_data_file):
-                if os.path.isfile(accumulated_data_file):
-                    # Could read the file contents to get last entry but is it
-                    # worth it?
-                    last_accumulated = datetime.fromtimestamp(
-                        os.path.getmtime(accumulated_data_file)
-                    )
-                else:
-                    last_accumulated = now - datetime.timedelta(days=5)
-
-                next_accumulate_midnight = last_accumulated.replace(
-                    hour=0, minute=0, second=0, microsecond=0
-                ) + datetime.timedelta(days=2)
-
-                if next_accumulate_midnight > now:
-                    continue
-
-                period_start = next_accumulate_midnight - datetime.timedelta(days=1)
-                period_end = next_accumulate_midnight
-                duration = 0
-                with open(discrete_data_file, "r") as f:
-                    for line in f:
-                        fields = line.split(",")
-                        timestamp = datetime.fromtimestamp(fields[0])
-                        print(timestamp)
+            discrete_path = series_path(station, "discrete", stat)
+            if segmented_storage.is_series(discrete_path):
+                accumulate_series(discrete_path, series_path(station, "daily", stat))
 
 
 def truncate_data_files():
     """Remove readings from data files that are past the retention
-    period. Only process files once a week to save disk IO. Store that
-    last truncate timestamp as the new_day signal is also sent on
-    startup.
+    period. Whole weekly segments are deleted, so this is cheap enough
+    to run on every new_day signal.
     """
-
-    # Signal new_day is also sent a program start, but we only want to
-    # truncate once a week to limit IO?
-    if settings["last_truncate"] + (86400 * 7) > gv.now:
-        return
-
-    now = int(gv.now)
     # Convert seconds to miliseconds
-    retention = RETENTION * 1000
-    now_milli = now * 1000
+    cutoff = (int(gv.now) - RETENTION) * 1000
 
-    settings["last_truncate"] = now
-    with open(CONFIG_FILE_PATH, "w") as f:
-        json.dump(settings, f)
+    flush_stats()
 
     # for station in settings["stations"].keys():
     for station in range(0, len(gv.snames)):
         for stat in ["planned", "actual", "diff"]:
             for period in ["discrete", "daily"]:
-                data_file = os.path.join(
-                    SCHEDULE_DATA_PATH, period, str(station) + "_" + stat + ".csv"
-                )
-                data_file_tmp = f"/tmp/{station}.tmp"
-
-                if os.path.isfile(data_file):
-                    with open(data_file, "r") as input:
-                        with open(data_file_tmp, "w") as output:
-                            # Copy headers straight to output
-                            output.write(input.readline())
-
-                            for line in input:
-                                fields = line.split(",")
-                                if int(fields[0]) + retention > now_milli:
-                                    output.write(line)
-
-                    try:
-                        # Best option as new sensor data my be being written to file
-                        os.replace(data_file_tmp, data_file)
-                    except OSError as e:
-                        print(f"Cannot replace {data_file}", e)
-                        os.remove(data_file_tmp)
+                path = series_path(station, period, stat)
+                if segmented_storage.is_series(path):
+                    segmented_storage.open_series(path).expire(cutoff)
+
+    # Forget the accumulate offsets of deleted segments
+    offsets = settings.setdefault("accumulate_offsets", {})
+    for segment_file in list(offsets):
+        if not os.path.isfile(segment_file):
+            del offsets[segment_file]
+
+    save_schedule_data_collector_settings()
 
 
 def process_data_files(name, **kw):
-    """Remove readings from data files that are past the retention
-    period. Only process files once a week to save disk IO. Store that
-    last truncate timestamp as the new_day signal is also sent on
-    startup.
+    """Accumulate the daily totals then remove readings that are past
+    the retention period. The new_day signal is also sent on startup.
     """
-    truncate_data_files()
     accumulate_data_files()
+    truncate_data_files()
 
 
 def notify_station_completed(station_no, **kw):
@@ -203,17 +321,31 @@ def load_schedule_data_collector_settings():
 
     except IOError:
         # If file does not exist return default value
-        settings = {"stations": {}, "last_truncate": 0}
+        settings = {"stations": {}}
 
 
-def schedule_data_collector_init():
-    if not os.path.isdir(SCHEDULE_DATA_PATH):
-        os.makedirs(SCHEDULE_DATA_PATH, exist_ok=True)
-        os.makedirs(os.path.join(SCHEDULE_DATA_PATH, "discrete"), exist_ok=True)
-        os.makedirs(os.path.join(SCHEDULE_DATA_PATH, "daily"), exist_ok=True)
+def save_schedule_data_collector_settings():
+    with open(CONFIG_FILE_PATH, "w") as f:
+        json.dump(settings, f)
+
 
+def schedule_data_collector_init():
     load_schedule_data_collector_settings()
 
+    for period in ["discrete", "daily"]:
+        period_path = os.path.join(SCHEDULE_DATA_PATH, period)
+        os.makedirs(period_path, exist_ok=True)
+
+        # Convert the CSV files of older versions to segmented series
+        for filename in os.listdir(period_path):
+            if filename.endswith(".csv"):
+                data_file = os.path.join(period_path, filename)
+                path = os.path.splitext(data_file)[0]
+                if not os.path.exists(path):
+                    os.replace(data_file, path)
+                    segmented_storage.open_series(path)
+                    settings.get("accumulate_offsets", {}).pop(data_file, None)
+
 
 new_day_signal = signal("new_day")
 new_day_signal.connect(process_data_files)
@@ -221,5 +353,9 @@ new_day_signal.connect(process_data_files)
 completed_signal = signal("station_completed")
 completed_signal.connect(notify_station_completed)
 
+restarting_signal = signal("restarting")
+restarting_signal.connect(flush_stats)
+atexit.register(flush_stats)
+
 # Run when plugin is loaded
 schedule_data_collector_init()
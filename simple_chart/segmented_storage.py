@@ -0,0 +1,292 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Time series storage shared by the plugins that collect chart data.
+
+Each series is a directory holding one CSV segment per week
+(YYYY-MM-DD.csv, named after the Monday the week starts on) and a
+manifest.json listing the segments and the time span they cover. Rows
+use the Simple Chart format "x,y" with x the timestamp in milliseconds.
+Timestamps are SIP times (gv.now), local wall time encoded as UTC, so
+weeks and days are computed in UTC and do not move with the time zone.
+
+Retention deletes whole segments so no file is ever rewritten, and
+readers only open the segments that overlap the window they need.
+
+Shipped by the Simple Chart and Schedule Data Collector plugins, both
+installing it to ./plugins/segmented_storage_helpers so one module is
+loaded. Keep simple_chart/segmented_storage.py and
+schedule_data_collector/segmented_storage.py identical.
+"""
+
+import calendar
+import datetime
+import json
+import os
+import shutil
+import threading
+
+MANIFEST = "manifest.json"
+HEADERS = "x,y\n"
+
+# Series opened by this process, path -> SegmentedSeries
+series_cache = {}
+series_cache_lock = threading.Lock()
+
+
+def week_start(timestamp_ms):
+    """Return the Monday of the week holding timestamp_ms"""
+    day = datetime.datetime.utcfromtimestamp(timestamp_ms / 1000).date()
+    return day - datetime.timedelta(days=day.weekday())
+
+
+def day_milli(day):
+    """Return midnight of a date as a SIP timestamp in milliseconds"""
+    return calendar.timegm(day.timetuple()) * 1000
+
+
+def is_series(path):
+    """True if path is a segmented series directory"""
+    return os.path.isfile(os.path.join(path, MANIFEST))
+
+
+def open_series(path):
+    """Return the series stored at path, creating it if required. A plain
+    CSV file found at path is converted to segments.
+    """
+    path = os.path.normpath(path)
+    with series_cache_lock:
+        if path not in series_cache:
+            series_cache[path] = SegmentedSeries(path)
+        return series_cache[path]
+
+
+class SegmentedSeries:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.segments = []
+
+        self.recover()
+        if os.path.isfile(path):
+            self.convert_file()
+        elif is_series(path):
+            self.load_manifest()
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.save_manifest()
+
+    def recover(self):
+        """Clean up after a conversion interrupted by a crash"""
+        if os.path.isdir(self.path + ".tmp"):
+            shutil.rmtree(self.path + ".tmp", ignore_errors=True)
+        if os.path.isfile(self.path + ".old"):
+            if os.path.exists(self.path):
+                os.remove(self.path + ".old")
+            else:
+                os.replace(self.path + ".old", self.path)
+
+    def load_manifest(self):
+        try:
+            with open(os.path.join(self.path, MANIFEST), "r") as f:
+                saved = json.load(f)["segments"]
+            # Spans of older versions were computed in local time
+            self.segments = [
+                self.segment_entry(
+                    datetime.date.fromisoformat(os.path.splitext(s["file"])[0])
+                )
+                for s in saved
+            ]
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            print(f"Rebuilding manifest of {self.path}", e)
+            self.rebuild_manifest()
+            return
+
+        if self.segments != saved:
+            self.save_manifest()
+
+    def rebuild_manifest(self):
+        """List the segment files found in the directory"""
+        self.segments = []
+        for name in sorted(os.listdir(self.path)):
+            try:
+                start = datetime.date.fromisoformat(os.path.splitext(name)[0])
+            except ValueError:
+                continue
+            self.segments.append(self.segment_entry(start))
+        self.save_manifest()
+
+    def save_manifest(self):
+        manifest_file = os.path.join(self.path, MANIFEST)
+        with open(manifest_file + ".tmp", "w") as f:
+            json.dump({"period": "week", "segments": self.segments}, f)
+        os.replace(manifest_file + ".tmp", manifest_file)
+
+    def segment_entry(self, start):
+        return {
+            "file": start.isoformat() + ".csv",
+            "start": day_milli(start),
+            "end": day_milli(start + datetime.timedelta(days=7)),
+        }
+
+    def segment_file(self, timestamp_ms):
+        """Return the segment file for timestamp_ms, adding it to the
+        manifest if it is new.
+        """
+        entry = self.segment_entry(week_start(timestamp_ms))
+        segment_file = os.path.join(self.path, entry["file"])
+
+        if not any(s["file"] == entry["file"] for s in self.segments):
+            if not os.path.exists(segment_file):
+                with open(segment_file, "w") as f:
+                    f.write(HEADERS)
+            self.segments.append(entry)
+            self.segments.sort(key=lambda s: s["start"])
+            self.save_manifest()
+
+        return segment_file
+
+    def convert_file(self):
+        """Split a plain CSV file into segments. The segments are built in
+        a temporary directory which then replaces the file, so the file is
+        kept until the series is complete.
+        """
+        csv_file = self.path
+        old_file = csv_file + ".old"
+        self.path = csv_file + ".tmp"
+        os.makedirs(self.path)
+        self.save_manifest()
+
+        rows = {}
+        with open(csv_file, "r") as f:
+            # Skip headers
+            f.readline()
+            for line in f:
+                try:
+                    timestamp_ms = int(float(line.split(",")[0]))
+                except ValueError:
+                    continue
+                rows.setdefault(self.segment_file(timestamp_ms), []).append(line)
+
+        for segment_file, lines in rows.items():
+            with open(segment_file, "a") as f:
+                f.writelines(lines)
+
+        self.path = csv_file
+        os.replace(csv_file, old_file)
+        os.replace(csv_file + ".tmp", csv_file)
+        os.remove(old_file)
+
+    def append(self, rows):
+        """Append (timestamp_ms, value) rows"""
+        lines = {}
+        with self.lock:
+            for timestamp_ms, value in rows:
+                lines.setdefault(self.segment_file(timestamp_ms), []).append(
+                    f"{timestamp_ms},{value}\n"
+                )
+
+            for segment_file, segment_lines in lines.items():
+                with open(segment_file, "a") as f:
+                    f.writelines(segment_lines)
+
+    def merge(self, rows):
+        """Set the value of (timestamp_ms, value) rows, replacing the value
+        of rows with the same timestamp. Only the segments holding the
+        rows are rewritten, so use for small series such as daily totals.
+        """
+        updates = {}
+        with self.lock:
+            for timestamp_ms, value in rows:
+                updates.setdefault(self.segment_file(timestamp_ms), {})[
+                    timestamp_ms
+                ] = value
+
+            for segment_file, values in updates.items():
+                with open(segment_file, "r") as f:
+                    f.readline()
+                    for line in f:
+                        fields = line.rstrip("\n").split(",")
+                        try:
+                            values.setdefault(int(float(fields[0])), fields[1])
+                        except (ValueError, IndexError):
+                            continue
+
+                with open(segment_file + ".tmp", "w") as f:
+                    f.write(HEADERS)
+                    for timestamp_ms in sorted(values):
+                        f.write(f"{timestamp_ms},{values[timestamp_ms]}\n")
+                os.replace(segment_file + ".tmp", segment_file)
+
+    def segment_files(self):
+        """Return (start, end, path) of each segment in time order"""
+        with self.lock:
+            return [
+                (s["start"], s["end"], os.path.join(self.path, s["file"]))
+                for s in self.segments
+            ]
+
+    def read(self, start_ms=None, end_ms=None):
+        """Return the data lines between start_ms and end_ms (both
+        optional), headers not included.
+        """
+        lines = []
+        for start, end, segment_file in self.segment_files():
+            if (start_ms is not None and end <= start_ms) or (
+                end_ms is not None and start >= end_ms
+            ):
+                continue
+
+            # Only rows of segments partly in the window need checking
+            check = (start_ms is not None and start < start_ms) or (
+                end_ms is not None and end > end_ms
+            )
+            try:
+                with open(segment_file, "r") as f:
+                    f.readline()
+                    for line in f:
+                        if check:
+                            try:
+                                timestamp_ms = int(float(line.split(",")[0]))
+                            except ValueError:
+                                continue
+                            if start_ms is not None and timestamp_ms < start_ms:
+                                continue
+                            if end_ms is not None and timestamp_ms >= end_ms:
+                                continue
+                        lines.append(line)
+            except IOError:
+                continue
+
+        return lines
+
+    def expire(self, cutoff_ms):
+        """Delete the segments holding only rows older than cutoff_ms"""
+        with self.lock:
+            expired = [s for s in self.segments if s["end"] <= cutoff_ms]
+            if not expired:
+                return
+
+            for segment in expired:
+                try:
+                    os.remove(os.path.join(self.path, segment["file"]))
+                except OSError as e:
+                    print(f"Cannot remove {segment['file']}", e)
+
+            self.segments = [s for s in self.segments if s["end"] > cutoff_ms]
+            self.save_manifest()
+
+    def rename(self, new_path):
+        new_path = os.path.normpath(new_path)
+        with series_cache_lock, self.lock:
+            os.rename(self.path, new_path)
+            series_cache.pop(self.path, None)
+            self.path = new_path
+            series_cache[new_path] = self
+
+    def delete(self):
+        with series_cache_lock, self.lock:
+            shutil.rmtree(self.path, ignore_errors=True)
+            series_cache.pop(self.path, None)
+            self.segments = []
@@ -14,6 +14,11 @@ from webpages import ProtectedPage  # Needed for security
 import os
 import re
 import glob
+import sys
+
+# Storage shared with the plugins collecting chart data
+sys.path.insert(0, "./plugins/segmented_storage_helpers")
+import segmented_storage
 
 
 # Add new URLs to access classes in this plugin.
@@ -22,6 +27,7 @@ urls.extend([
     u"/simple_chart", u"plugins.simple_chart.display_charts",
     u"/simple_chart-save", u"plugins.simple_chart.save_settings",
     u"/simple_chart_config", u"plugins.simple_chart.get_settings",
+    u"/simple_chart-data/(.+)", u"plugins.simple_chart.get_data",
 
     ])
 # fmt: on
@@ -32,6 +38,9 @@ gv.plugin_menu.append([("Simple Chart"), "/simple_chart"])
 settings = {}
 CONFIG_FILE_PATH = "./data/simple_chart.json"
 CONFIG_DIR_PATH = "./data/simple_chart"
+DATA_DIR_PATH = "./static/data"
+# Segmented series are loaded through get_data
+SERIES_URL = "simple_chart-data/"
 
 
 def load_settings():
@@ -77,22 +86,32 @@ def load_settings():
         # print(settings)
         settings[chart_name]["data"] = []
         for data_path in chart_defaults["data"]:
-            if os.path.isdir(data_path):
+            if segmented_storage.is_series(data_path):
+                settings[chart_name]["data"].append(data_url(data_path))
+            elif os.path.isdir(data_path):
                 conf_filenames = os.listdir(data_path)
                 for conf_filename in conf_filenames:
                     settings[chart_name]["data"].append(
-                        os.path.join(data_path, conf_filename)
+                        data_url(os.path.join(data_path, conf_filename))
                     )
             elif os.path.isfile(data_path):
                 settings[chart_name]["data"].append(data_path)
             else:
                 conf_filenames = glob.glob(data_path)
                 for conf_filename in conf_filenames:
-                    settings[chart_name]["data"].append(conf_filename)
+                    settings[chart_name]["data"].append(data_url(conf_filename))
 
         settings[chart_name]["data"].sort()
 
 
+def data_url(data_path):
+    """Return the URL the chart loads data_path from"""
+    if segmented_storage.is_series(data_path):
+        return SERIES_URL + data_path
+
+    return data_path
+
+
 class display_charts(ProtectedPage):
     """
     Load an html page for entering plugin settings.
@@ -122,6 +141,34 @@ class get_settings(ProtectedPage):
         return template_render.simple_chart_config(settings)
 
 
+class get_data(ProtectedPage):
+    """
+    Return a segmented series as one CSV file. The optional since and
+    until query values (milliseconds) limit the rows returned.
+    """
+
+    def GET(self, data_path):
+        data_path = os.path.normpath(data_path)
+        data_root = os.path.realpath(DATA_DIR_PATH)
+        if not os.path.realpath(data_path).startswith(data_root + os.sep):
+            raise web.notfound()
+
+        if not segmented_storage.is_series(data_path):
+            raise web.notfound()
+
+        qdict = web.input(since=None, until=None)
+        try:
+            since = int(qdict.since) if qdict.since else None
+            until = int(qdict.until) if qdict.until else None
+        except ValueError:
+            raise web.badrequest()
+
+        lines = segmented_storage.open_series(data_path).read(since, until)
+
+        web.header("Content-Type", "text/csv")
+        return segmented_storage.HEADERS + "".join(lines)
+
+
 class save_settings(ProtectedPage):
     """
     Save user input to json file.